@@ -1,5 +1,12 @@
 import os
+import json
+import glob
+import hashlib
 import logging
+import sqlite3
+import argparse
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import tensorflow as tf
 from tensorflow import keras
@@ -11,6 +18,12 @@ SEED = 123
 EPOCHS = 10
 IMAGE_SIZE = (180, 180)
 BATCH_SIZE = 32
+STREAMING_SCAN = True  # Use the batched tf.data pipeline instead of one predict() per file
+SHARD_SIZE = BATCH_SIZE * 8  # Files handed to a worker process at a time when scanning with --workers
+JPEG_SCALES = (8, 4, 2, 1)  # Downscaling ratios libjpeg can apply while decoding
+# File types tf.io.decode_image can read, by extension and by leading magic bytes
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp'}
+IMAGE_MAGIC = (b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n', b'GIF87a', b'GIF89a', b'BM')
 
 # Set up logging
 logging.basicConfig(filename='errors.log', level=logging.ERROR)
@@ -19,6 +32,8 @@ logging.basicConfig(filename='errors.log', level=logging.ERROR)
 training_dir = '/mnt/Work/wk/ia-hiking-signs/photos'
 testing_dir1 = '/mnt/Work/Images/Camera' # '/home/binnette/Images/'
 results = 'images_new.txt'
+model_store = 'models'
+scan_index = 'scan_index.sqlite'
 
 # Ensure TensorFlow uses CPU only
 os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
@@ -29,10 +44,6 @@ if physical_devices:
     except:
         pass
 
-# Remove results file if it exists
-if os.path.exists(results):
-    os.remove(results)
-
 def trainModel():
     # Load and preprocess the training data
     train_dataset = image_dataset_from_directory(
@@ -81,8 +92,76 @@ def trainModel():
 
     return model, train_dataset
 
+def training_fingerprint():
+    """
+    Fingerprint the training set and the hyperparameters.
+
+    Every file below training_dir contributes its relative path, size and modification time,
+    so adding, removing or replacing a training picture changes the fingerprint.
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps([SEED, EPOCHS, list(IMAGE_SIZE), BATCH_SIZE]).encode())
+    for subdir, dirs, files in os.walk(training_dir):
+        dirs.sort()  # Walk in a stable order
+        for file in sorted(files):
+            file_path = os.path.join(subdir, file)
+            stat = os.stat(file_path)
+            digest.update(f"{os.path.relpath(file_path, training_dir)}|{stat.st_size}|{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()[:16]
+
+# Function to get the artifact paths (model and metadata) for a fingerprint
+def artifact_paths(fingerprint):
+    base = os.path.join(model_store, f"classifier-{fingerprint}")
+    return base + '.keras', base + '.json'
+
+def save_model(model, class_names, fingerprint):
+    os.makedirs(model_store, exist_ok=True)
+    model_path, meta_path = artifact_paths(fingerprint)
+    model.save(model_path)
+    # Metadata is written last, so an artifact only counts once the model is fully saved
+    with open(meta_path, 'w') as meta:
+        json.dump({"fingerprint": fingerprint, "class_names": class_names}, meta, indent=2)
+
+def load_model(fingerprint):
+    model_path, meta_path = artifact_paths(fingerprint)
+    with open(meta_path, 'r') as meta:
+        class_names = json.load(meta)["class_names"]
+    return keras.models.load_model(model_path), class_names
+
+# Function to find the fingerprint of the most recently saved artifact
+def latest_fingerprint():
+    meta_paths = glob.glob(os.path.join(model_store, 'classifier-*.json'))
+    if not meta_paths:
+        return None
+    with open(max(meta_paths, key=os.path.getmtime), 'r') as meta:
+        return json.load(meta)["fingerprint"]
+
+def get_model(scan_only=False, retrain=False):
+    """
+    Return (model, class_names, fingerprint), training only when needed.
+
+    With scan_only the latest saved artifact is loaded without looking at the training set.
+    Otherwise the artifact matching the current training set is loaded, or trained and saved.
+    """
+    if scan_only:
+        fingerprint = latest_fingerprint()
+        if fingerprint is None:
+            raise SystemExit(f"Error: No trained classifier in {model_store}, run once without --scan-only.")
+        model, class_names = load_model(fingerprint)
+        return model, class_names, fingerprint
+
+    fingerprint = training_fingerprint()
+    if not retrain and os.path.exists(artifact_paths(fingerprint)[1]):
+        print(f"Training set unchanged, loading classifier {fingerprint}")
+        model, class_names = load_model(fingerprint)
+        return model, class_names, fingerprint
+
+    model, train_dataset = trainModel()
+    save_model(model, train_dataset.class_names, fingerprint)
+    return model, train_dataset.class_names, fingerprint
+
 # Function to predict and display results
-def predict_and_display(model, train_dataset, image_dir, results, target_class=None, min_confidence=0):
+def predict_and_display(model, class_names, image_dir, results, target_class=None, min_confidence=0):
     with open(results, 'a') as txt:
         for subdir, dirs, files in os.walk(image_dir):
             for file in files:
@@ -97,7 +176,7 @@ def predict_and_display(model, train_dataset, image_dir, results, target_class=N
                     predictions = model.predict(img_array)
                     score = tf.nn.softmax(predictions[0])
                     confidence = 100 * np.max(score)
-                    class_name = train_dataset.class_names[np.argmax(score)]
+                    class_name = class_names[np.argmax(score)]
 
                     # Print and write to file if the predicted class matches the target class and confidence is above the minimum
                     if (target_class is None or class_name == target_class) and confidence > min_confidence:
@@ -107,12 +186,282 @@ def predict_and_display(model, train_dataset, image_dir, results, target_class=N
                 except Exception as e:
                     logging.error(f"Error on file: {image_path} => {e}")
 
+# Function to list every file below a directory, in walk order
+def list_images(image_dir):
+    paths = []
+    for subdir, dirs, files in os.walk(image_dir):
+        for file in files:
+            paths.append(os.path.join(subdir, file))
+    return paths
+
+# Function to decode a JPEG at the smallest libjpeg scale that still covers IMAGE_SIZE
+def decode_reduced_jpeg(contents):
+    shape = tf.io.extract_jpeg_shape(contents)
+    short_side = tf.minimum(shape[0], shape[1])
+    # Index of the first (largest) ratio that keeps the short side above the model input size
+    fits = tf.stack([short_side // scale >= max(IMAGE_SIZE) for scale in JPEG_SCALES[:-1]] + [tf.constant(True)])
+    branch = tf.argmax(tf.cast(fits, tf.int32), output_type=tf.int32)
+    decoders = [lambda scale=scale: tf.io.decode_jpeg(contents, channels=3, ratio=scale) for scale in JPEG_SCALES]
+    return tf.switch_case(branch, decoders)
+
+# Function to decode and resize one image inside the tf.data pipeline
+def load_image(image_path, reduced_decode=False):
+    contents = tf.io.read_file(image_path)
+    if reduced_decode:
+        # DCT-domain downscaling for JPEG files, full decode for the other formats
+        image = tf.cond(
+            tf.strings.substr(contents, 0, 3) == b'\xff\xd8\xff',
+            lambda: decode_reduced_jpeg(contents),
+            lambda: tf.io.decode_image(contents, channels=3, expand_animations=False)
+        )
+    else:
+        image = tf.io.decode_image(contents, channels=3, expand_animations=False)
+    # Bilinear resize, like image_dataset_from_directory does for the training set
+    image = tf.image.resize(image, IMAGE_SIZE)
+    return image_path, image
+
+# Function to build the streaming dataset: parallel decode, full batches, prefetch
+def build_scan_dataset(paths, threads=None, reduced_decode=False):
+    dataset = tf.data.Dataset.from_tensor_slices(paths)
+    if threads:
+        # Keep each worker process on its own share of the cores
+        options = tf.data.Options()
+        options.threading.private_threadpool_size = threads
+        dataset = dataset.with_options(options)
+    dataset = dataset.map(lambda image_path: load_image(image_path, reduced_decode), num_parallel_calls=tf.data.AUTOTUNE)
+    # A corrupt file is dropped from the stream instead of aborting its batch
+    dataset = dataset.ignore_errors()
+    dataset = dataset.batch(BATCH_SIZE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+def classify_images(model, class_names, paths, threads=None, reduced_decode=False):
+    """
+    Classify the given files in batches of BATCH_SIZE.
+
+    Yields (path, class_name, confidence) in the order of paths. Files that could not be
+    decoded are yielded with class_name and confidence set to None.
+    """
+    if not paths:
+        return
+    pending = iter(paths)
+    for batch_paths, batch_images in build_scan_dataset(paths, threads, reduced_decode):
+        predictions = model(batch_images, training=False)
+        scores = tf.nn.softmax(predictions).numpy()
+        for image_path, score in zip(batch_paths.numpy(), scores):
+            image_path = os.fsdecode(image_path)
+            # Files skipped by the pipeline are the ones missing before this path
+            for skipped_path in pending:
+                if skipped_path == image_path:
+                    break
+                yield skipped_path, None, None
+            yield image_path, class_names[np.argmax(score)], 100 * np.max(score)
+    for skipped_path in pending:
+        yield skipped_path, None, None
+
+# Model loaded once per worker process by init_worker
+worker_model = None
+worker_class_names = None
+worker_threads = None
+worker_reduced_decode = False
+
+def init_worker(fingerprint, threads, reduced_decode):
+    global worker_model, worker_class_names, worker_threads, worker_reduced_decode
+    # Thread counts must be set before TensorFlow runs its first op in this process
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    worker_model, worker_class_names = load_model(fingerprint)
+    worker_threads = threads
+    worker_reduced_decode = reduced_decode
+
+def classify_shard(paths):
+    return list(classify_images(worker_model, worker_class_names, paths, worker_threads, worker_reduced_decode))
+
+def classify_sharded(fingerprint, paths, workers, reduced_decode=False):
+    """
+    Classify paths across worker processes, each holding its own copy of the saved model.
+
+    The list is cut into shards of SHARD_SIZE files. Shards are consumed in order, so the
+    results come back in the same order as paths whatever worker finishes first.
+    """
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    shards = [paths[i:i + SHARD_SIZE] for i in range(0, len(paths), SHARD_SIZE)]
+    # TensorFlow is not fork-safe, workers start from a fresh interpreter
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(workers, initializer=init_worker, initargs=(fingerprint, threads, reduced_decode)) as pool:
+        for shard_results in pool.imap(classify_shard, shards):
+            yield from shard_results
+
+# Function to check the first bytes of a file against the supported image formats
+def has_image_magic(image_path):
+    try:
+        with open(image_path, 'rb') as f:
+            header = f.read(8)
+    except OSError:
+        return False
+    return header.startswith(IMAGE_MAGIC)
+
+def prefilter_images(paths, check_magic=True):
+    """
+    Drop files that cannot be images before they reach the decoder.
+
+    Returns (kept_paths, skipped_by_extension, skipped_by_magic). The magic-bytes check
+    reads 8 bytes per file, from a thread pool since it is bound by file system latency;
+    without check_magic, only the extension is checked.
+    """
+    candidates = [p for p in paths if os.path.splitext(p)[1].lower() in IMAGE_EXTENSIONS]
+    if not check_magic:
+        return candidates, len(paths) - len(candidates), 0
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        is_image = list(executor.map(has_image_magic, candidates))
+    kept = [p for p, ok in zip(candidates, is_image) if ok]
+    return kept, len(paths) - len(candidates), len(candidates) - len(kept)
+
+def open_index(index_path=scan_index):
+    """
+    Open the file-state index, creating it if needed.
+
+    One row per scanned file, keyed by path. size, mtime_ns and fingerprint tell whether the
+    stored prediction is still valid; class_name and confidence are NULL for unreadable files.
+    """
+    connection = sqlite3.connect(index_path)
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            fingerprint TEXT NOT NULL,
+            class_name TEXT,
+            confidence REAL
+        )
+    """)
+    return connection
+
+def pending_images(connection, paths, fingerprint):
+    """
+    Return {path: (size, mtime_ns)} for the files that are new, changed or scanned with another model.
+    """
+    known = {row[0]: tuple(row[1:]) for row in connection.execute("SELECT path, size, mtime_ns, fingerprint FROM files")}
+    pending = {}
+    for image_path in paths:
+        try:
+            stat = os.stat(image_path)
+        except OSError as e:
+            logging.error(f"Error on file: {image_path} => {e}")
+            continue
+        if known.get(image_path) != (stat.st_size, stat.st_mtime_ns, fingerprint):
+            pending[image_path] = (stat.st_size, stat.st_mtime_ns)
+    return pending
+
+# Function to forget files that disappeared from the scanned directory
+def prune_index(connection, image_dir, paths):
+    present = set(paths)
+    prefix = os.path.join(image_dir, '')
+    stale = [(row[0],) for row in connection.execute("SELECT path FROM files") if row[0].startswith(prefix) and row[0] not in present]
+    connection.executemany("DELETE FROM files WHERE path = ?", stale)
+    connection.commit()
+
+def is_match(class_name, confidence, target_class, min_confidence):
+    return class_name is not None and (target_class is None or class_name == target_class) and confidence > min_confidence
+
+# Function to write the results file from the index, without running the model
+def export_results(connection, results, target_class=None, min_confidence=0):
+    count = 0
+    with open(results, 'w') as txt:
+        for image_path, class_name, confidence in connection.execute("SELECT path, class_name, confidence FROM files ORDER BY path"):
+            if is_match(class_name, confidence, target_class, min_confidence):
+                txt.write(image_path + '\n')
+                count += 1
+    return count
+
+# Function to predict with the streaming tf.data pipeline and write results
+def predict_and_display_batched(model, class_names, fingerprint, image_dir, results, target_class=None, min_confidence=0, workers=1, prefilter=False):
+    connection = open_index()
+    paths = list_images(image_dir)
+    prune_index(connection, image_dir, paths)
+    pending = pending_images(connection, paths, fingerprint)
+    print(f"{len(paths) - len(pending)} files already indexed, {len(pending)} to classify")
+
+    # The extension check is always done, it keeps videos from being read whole by tf.io.read_file
+    to_classify, skipped_by_extension, skipped_by_magic = prefilter_images(list(pending), check_magic=prefilter)
+    decode_errors = 0
+    # Index skipped files without a class, so they are not checked again until they change
+    kept = set(to_classify)
+    connection.executemany(
+        "INSERT OR REPLACE INTO files (path, size, mtime_ns, fingerprint, class_name, confidence) VALUES (?, ?, ?, ?, NULL, NULL)",
+        [(image_path, size, mtime_ns, fingerprint) for image_path, (size, mtime_ns) in pending.items() if image_path not in kept]
+    )
+    connection.commit()
+
+    # Start from the matches already in the index, then append the new ones as they come
+    export_results(connection, results, target_class, min_confidence)
+    if workers > 1:
+        predictions = classify_sharded(fingerprint, to_classify, workers, reduced_decode=prefilter)
+    else:
+        predictions = classify_images(model, class_names, to_classify, reduced_decode=prefilter)
+    with open(results, 'a') as txt:
+        classified = 0
+        for image_path, class_name, confidence in predictions:
+            size, mtime_ns = pending[image_path]
+            if confidence is not None:
+                confidence = float(confidence)
+            connection.execute(
+                "INSERT OR REPLACE INTO files (path, size, mtime_ns, fingerprint, class_name, confidence) VALUES (?, ?, ?, ?, ?, ?)",
+                (image_path, size, mtime_ns, fingerprint, class_name, confidence)
+            )
+            classified += 1
+            # Commit once per batch, an interrupted run resumes from the last committed batch
+            if classified % BATCH_SIZE == 0:
+                connection.commit()
+
+            if class_name is None:
+                logging.error(f"Error on file: {image_path} => unable to decode image")
+                decode_errors += 1
+                continue
+
+            # Print and write to file if the predicted class matches the target class and confidence is above the minimum
+            if is_match(class_name, confidence, target_class, min_confidence):
+                print(f"Path: {image_path} Class: {class_name} Confidence: {confidence:.2f}%")
+                txt.write(image_path + '\n')
+                txt.flush()
+    connection.commit()
+    connection.close()
+
+    print(f"Skipped by extension: {skipped_by_extension}, by magic bytes: {skipped_by_magic}, by decode errors: {decode_errors}")
+    print(f"Classified: {classified - decode_errors}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Search hiking signs in a folder of pictures.")
+    parser.add_argument('--scan-only', action='store_true', help="Load the latest saved classifier and never train")
+    parser.add_argument('--retrain', action='store_true', help="Train even if the training set did not change")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes used to classify")
+    parser.add_argument('--prefilter', action='store_true', help="Also skip files without image magic bytes, and decode JPEG files at reduced scale")
+    parser.add_argument('--query', action='store_true', help="Only rewrite the results file from the scan index")
+    parser.add_argument('--target-class', default="HikingSigns", help="Class to keep in the results file")
+    parser.add_argument('--min-confidence', type=float, default=70, help="Minimum confidence (in %%) to keep a file")
+    return parser.parse_args()
+
 def main():
-    # Train the model
-    model, train_dataset = trainModel()
+    args = parse_args()
+
+    # Re-emit the results file from the index, no model needed
+    if args.query:
+        connection = open_index()
+        count = export_results(connection, results, args.target_class, args.min_confidence)
+        connection.close()
+        print(f"{count} files written to {results}")
+        return
+
+    # Load the saved model, training it only if the training set changed
+    model, class_names, fingerprint = get_model(scan_only=args.scan_only, retrain=args.retrain)
 
     # Run predictions on new images
-    predict_and_display(model, train_dataset, testing_dir1, results, target_class="HikingSigns", min_confidence=70)
+    if STREAMING_SCAN:
+        predict_and_display_batched(model, class_names, fingerprint, testing_dir1, results, target_class=args.target_class, min_confidence=args.min_confidence, workers=args.workers, prefilter=args.prefilter)
+    else:
+        # Remove results file if it exists
+        if os.path.exists(results):
+            os.remove(results)
+        predict_and_display(model, class_names, testing_dir1, results, target_class=args.target_class, min_confidence=args.min_confidence)
 
 if __name__ == "__main__":
     main()
@@ -1,58 +1,317 @@
 # apt install python3-tk python3-pil python3-pil.imagetk
 import os
+import json
+import queue
+import hashlib
+import argparse
 import shutil
-from tkinter import Tk, Label, Text, Button, Frame
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from tkinter import Tk, Label, Text, Button, Frame, TclError
 from PIL import Image, ImageTk
+from exifGps import atomic_write, read_gps_bulk
 
-# Function to handle the 'Yes' button click or left arrow key press
-def yes_action(event=None):  # Add 'event=None' to handle the key press event
-    image_path = image_list[image_index]
+PREFETCH_COUNT = 6  # Images decoded ahead of the current one
+CACHE_SIZE = 16  # Decoded images kept in memory, the least recently used are dropped
+JOURNAL_FILE = 'sort_journal.jsonl'  # Append-only log of the decisions, used to resume and undo
+YES_FOLDER = 'signToCheck'
+NO_FOLDER = '.'
+GRID_ROWS = 4
+GRID_COLUMNS = 4
+GRID_KEYS = '1234qwerasdfzxcv'  # Key toggling each tile of the grid, row by row
+THUMBNAIL_FOLDER = '.thumbnails'  # On-disk cache of the grid thumbnails
+
+# Function to append one entry to the journal, from the GUI or the I/O thread
+def write_journal(entry):
+    with journal_lock:
+        journal.write(json.dumps(entry) + '\n')
+        journal.flush()
+
+def read_journal():
+    """
+    Replay the journal and return (decisions, pending, results, next_id).
+
+    decisions lists the decisions that were not undone, oldest first. pending lists those whose
+    file operation was never marked done, e.g. because the previous session was killed. results
+    maps the id of each done operation to whether it succeeded.
+    """
+    decisions = OrderedDict()
+    results = {}
+    next_id = 0
+    if os.path.exists(JOURNAL_FILE):
+        with open(JOURNAL_FILE, 'r') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # Last line cut by a crash
+                next_id = max(next_id, entry['id'] + 1)
+                if entry['action'] in ('yes', 'no'):
+                    decisions[entry['id']] = entry
+                elif entry['action'] == 'undo':
+                    decisions.pop(entry['id'], None)
+                elif entry['action'] == 'done':
+                    results[entry['id']] = entry.get('ok', True)
+    pending = [entry for entry in decisions.values() if entry['id'] not in results]
+    return list(decisions.values()), pending, results, next_id
+
+# Function to run the file operations one after the other, away from the GUI thread
+def io_worker():
+    while True:
+        entry_id, operation, args, callback = io_queue.get()
+        ok = True
+        try:
+            operation(*args)
+        except Exception as e:
+            ok = False
+            print(f"Error on file: {args[0]} => {e}")
+        if entry_id is not None:
+            operation_results[entry_id] = ok
+            write_journal({'id': entry_id, 'action': 'done', 'ok': ok})
+        if callback is not None:
+            io_callbacks.put(callback)
+        io_queue.task_done()
+
+# Function to show the I/O progress and run the callbacks of finished operations on the GUI thread
+def poll_io():
+    while not io_callbacks.empty():
+        io_callbacks.get()()
     try:
-        shutil.move(image_path, 'signToCheck')  # Move the image
-    except Exception as e:
-        print(f"Error on file: {image_path} => {e}")
+        io_label.config(text=f'Pending file operations: {io_queue.unfinished_tasks}')
+    except TclError:
+        return  # The window was closed, e.g. by a callback showing the last image
+    root.after(200, poll_io)
+
+# Function to queue the file operation of a decision
+def queue_decision(entry):
+    if entry['action'] == 'yes':
+        io_queue.put((entry['id'], shutil.move, (entry['path'], YES_FOLDER), None))  # Move the image
+    else:
+        io_queue.put((entry['id'], shutil.copy, (entry['path'], NO_FOLDER), None))
+
+# Function to journal a decision and queue its file operation
+def record_decision(index, action, page=None):
+    global next_entry_id
+    entry = {'id': next_entry_id, 'action': action, 'index': index, 'path': image_list[index]}
+    if page is not None:
+        entry['page'] = page
+    next_entry_id += 1
+    decisions.append(entry)
+    write_journal(entry)
+    queue_decision(entry)
+
+# Function to record a decision on the current image and move on
+def decide(action):
+    if undo_pending or image_index >= len(image_list):
+        return  # The undone image is not shown yet
+    record_decision(image_index, action)
     root.after(0, update_image)  # Schedule the next update
 
+# Function to handle the 'Yes' button click or left arrow key press
+def yes_action(event=None):  # Add 'event=None' to handle the key press event
+    decide('yes')
+
 # Function to handle the 'No' button click or right arrow key press
 def no_action(event=None):  # Add 'event=None' to handle the key press event
+    decide('no')
+
+# Function to revert the file operation of a decision, run by the I/O thread after the operation itself
+def revert_decision(image_path, entry_id, action):
+    if not operation_results.get(entry_id, False):
+        return  # The move or copy failed, the files were left as they were
+    if action == 'yes':
+        shutil.move(os.path.join(YES_FOLDER, os.path.basename(image_path)), image_path)
+    else:
+        os.remove(os.path.join(NO_FOLDER, os.path.basename(image_path)))
+
+# Function to show the undone images once their files are back in place
+def undo_done():
+    global undo_pending
+    undo_pending = False
+    update_image()
+
+# Function to handle the 'Undo' button click or backspace key press
+def undo_action(event=None):
+    global image_index, undo_pending
+    if undo_pending or not decisions:
+        return
+    # In grid mode the whole last page is undone
+    entries = [decisions.pop()]
+    page = entries[0].get('page')
+    while page is not None and decisions and decisions[-1].get('page') == page:
+        entries.append(decisions.pop())
+    image_index = min(entry['index'] for entry in entries) - 1
+    # Until the undone images are shown, the decisions would apply to the wrong image
+    undo_pending = True
+    for number, entry in enumerate(entries):
+        write_journal({'id': entry['id'], 'action': 'undo'})
+        # The images are shown again once the last file is back in place
+        callback = undo_done if number == len(entries) - 1 else None
+        io_queue.put((None, revert_decision, (entry['path'], entry['id'], entry['action']), callback))
+
+# Function to toggle a tile of the grid between 'hiking sign' and 'not a hiking sign'
+def toggle_tile(tile_number):
+    if tile_number >= len(page_indices) or tiles[tile_number].image is None:
+        return
+    if tile_number in selected_tiles:
+        selected_tiles.remove(tile_number)
+        tiles[tile_number].config(bg=tile_background)
+    else:
+        selected_tiles.add(tile_number)
+        tiles[tile_number].config(bg='green')
+
+# Function to handle the 'Confirm page' button click or return key press in grid mode
+def confirm_page(event=None):
     global image_index
-    image_path = image_list[image_index]
-    try:
-        shutil.copy(image_path, '.')
-    except Exception as e:
-        print(f"Error on file: {image_path} => {e}")
+    if undo_pending or not page_indices:
+        return
+    for tile_number, index in enumerate(page_indices):
+        if tiles[tile_number].image is None:
+            continue  # Missing or unreadable file, left undecided
+        record_decision(index, 'yes' if tile_number in selected_tiles else 'no', page=page_indices[0])
+    image_index = page_indices[-1]
     root.after(0, update_image)  # Schedule the next update
 
-# Function to handle the 'Open' button click
+# Function to handle the 'Open' button click, in grid mode for the selected tiles or else the first one
 def open_action():
-    image_path = image_list[image_index]
-    try:
-        os.system(f"xdg-open {image_path}")  # Open the image with xdg-open command
-    except Exception as e:
-        print(f"Error opening file: {image_path} => {e}")
+    if grid_mode:
+        indices = [page_indices[tile_number] for tile_number in sorted(selected_tiles)] or page_indices[:1]
+    else:
+        indices = [image_index] if 0 <= image_index < len(image_list) else []
+    for index in indices:
+        image_path = image_list[index]
+        try:
+            os.system(f"xdg-open {image_path}")  # Open the image with xdg-open command
+        except Exception as e:
+            print(f"Error opening file: {image_path} => {e}")
+
+# Function to rotate an image according to its EXIF orientation tag
+def apply_exif_orientation(image):
+    exif_orientation = image.getexif().get(0x112, 1)
+    if exif_orientation == 3:
+        image = image.rotate(180, expand=True)
+    elif exif_orientation == 6:
+        image = image.rotate(-90, expand=True)
+    elif exif_orientation == 8:
+        image = image.rotate(90, expand=True)
+    return image
+
+# Function to decode, rotate and resize an image, run by the worker pool
+def load_display_image(image_path, size):
+    if not os.path.exists(image_path):
+        return None
+    with Image.open(image_path) as image:
+        image = apply_exif_orientation(image)
+        image.thumbnail(size, Image.Resampling.LANCZOS)
+        return image
+
+# Function to get the path of the cached thumbnail, which changes whenever the image changes
+def thumbnail_cache_path(image_path, size):
+    stat = os.stat(image_path)
+    key = f"{os.path.abspath(image_path)}|{stat.st_size}|{stat.st_mtime_ns}|{int(size[0])}x{int(size[1])}"
+    return os.path.join(THUMBNAIL_FOLDER, hashlib.sha1(key.encode()).hexdigest() + '.jpg')
+
+# Function to load a grid thumbnail from the disk cache, creating it if needed
+def load_thumbnail(image_path, size):
+    if not os.path.exists(image_path):
+        return None
+    cache_path = thumbnail_cache_path(image_path, size)
+    if os.path.exists(cache_path):
+        with Image.open(cache_path) as thumbnail:
+            thumbnail.load()
+            return thumbnail
+    with Image.open(image_path) as image:
+        # Let libjpeg decode at a reduced scale, the thumbnail is much smaller than the photo
+        image.draft('RGB', (int(max(size)), int(max(size))))
+        image = apply_exif_orientation(image)
+        image.thumbnail(size, Image.Resampling.LANCZOS)
+        thumbnail = image.convert('RGB')
+    os.makedirs(THUMBNAIL_FOLDER, exist_ok=True)
+    with atomic_write(cache_path, 'wb') as f:
+        thumbnail.save(f, 'JPEG', quality=85)
+    return thumbnail
+
+# Function to get the future of a decoded image, submitting it to the pool if needed
+def get_display_image(index):
+    if index in image_cache:
+        image_cache.move_to_end(index)
+    else:
+        if grid_mode:
+            image_cache[index] = executor.submit(load_thumbnail, image_list[index], thumbnail_size)
+        else:
+            image_cache[index] = executor.submit(load_display_image, image_list[index], img_size)
+        while len(image_cache) > cache_size:
+            _, future = image_cache.popitem(last=False)
+            future.cancel()
+    return image_cache[index]
+
+# Function to start decoding the next images in the background
+def prefetch_images(index):
+    for next_index in range(index + 1, min(index + 1 + prefetch_count, len(image_list))):
+        get_display_image(next_index)
+
+# Function to describe the GPS position of an image, once the background read is done
+def gps_text(index):
+    if not gps_positions.done() or gps_positions.exception():
+        return ''
+    gps = gps_positions.result().get(image_list[index])
+    if gps is None:
+        return ' - no GPS position'
+    lat, lon, altitude = gps
+    return f' - {lat:.5f}, {lon:.5f}' + (f', {altitude:.0f} m' if altitude is not None else '')
+
+# Function to update the grid of thumbnails with the next page of images
+def update_grid():
+    global page_indices, selected_tiles
+    start = image_index + 1
+    if start >= len(image_list):
+        root.destroy()  # Close the application if there are no more images
+        return
+    page_indices = list(range(start, min(start + len(tiles), len(image_list))))
+    selected_tiles = set()
+    image_name_label.config(text=os.path.dirname(image_list[start]))
+    without_gps = 0
+    if gps_positions.done() and not gps_positions.exception():
+        without_gps = sum(gps_positions.result().get(image_list[index]) is None for index in page_indices)
+    status_label.config(text=f'Images {start + 1}-{page_indices[-1] + 1}/{len(image_list)}' + (f' - {without_gps} without GPS position' if without_gps else ''))
+
+    for tile_number, tile in enumerate(tiles):
+        photo = None
+        if tile_number < len(page_indices):
+            index = page_indices[tile_number]
+            try:
+                image = get_display_image(index).result()
+            except Exception as e:
+                print(f"Error on file: {image_list[index]} => {e}")
+                image = None
+            if image is not None:
+                photo = ImageTk.PhotoImage(image)
+        tile.config(image=photo if photo else '', bg=tile_background)
+        tile.image = photo
+    # Generate the thumbnails of the next page while this one is reviewed
+    prefetch_images(page_indices[-1])
 
 # Function to update the image displayed
 def update_image():
     global img_size, image_index, image_label, status_label, image_name_label, root, image_list
+    if grid_mode:
+        update_grid()
+        return
     image_index += 1
     if image_index < len(image_list):
         image_path = image_list[image_index]
-        if os.path.exists(image_path):
-            image = Image.open(image_path)
+        try:
+            image = get_display_image(image_index).result()
+        except Exception as e:
+            print(f"Error on file: {image_path} => {e}")
+            image = None
+        prefetch_images(image_index)
+        if image is not None:
             image_name_label.config(text=image_path)
 
-            status_label.config(text=f'Image {image_index + 1}/{len(image_list)}')
+            status_label.config(text=f'Image {image_index + 1}/{len(image_list)}{gps_text(image_index)}')
 
-            exif_orientation = image._getexif().get(0x112, 1)
-            if exif_orientation == 3:
-                image = image.rotate(180, expand=True)
-            elif exif_orientation == 6:
-                image = image.rotate(-90, expand=True)
-            elif exif_orientation == 8:
-                image = image.rotate(90, expand=True)
-
-            image.thumbnail(img_size, Image.Resampling.LANCZOS)
-            
             photo = ImageTk.PhotoImage(image)
             image_label.config(image=photo)
             image_label.image = photo
@@ -68,12 +327,45 @@ def update_image():
     else:
         root.destroy()  # Close the application if there are no more images
 
+parser = argparse.ArgumentParser(description="Review the candidate hiking sign pictures.")
+parser.add_argument('--grid', action='store_true', help=f"Review a {GRID_ROWS}x{GRID_COLUMNS} grid of thumbnails per page")
+args = parser.parse_args()
+grid_mode = args.grid
+
 # Read the list of images from a text file
 with open('images.txt', 'r') as file:
     image_list = [line.strip() for line in file.readlines()]
 
 image_index = -1
 
+# Resume after the last decision of the previous session and finish its file operations
+journal_lock = threading.Lock()
+io_queue = queue.Queue()
+io_callbacks = queue.Queue()
+decisions, pending_decisions, operation_results, next_entry_id = read_journal()
+undo_pending = False
+if decisions:
+    last = decisions[-1]
+    if last['index'] < len(image_list) and image_list[last['index']] == last['path']:
+        image_index = last['index']
+    elif last['path'] in image_list:
+        image_index = image_list.index(last['path'])
+journal = open(JOURNAL_FILE, 'a')
+for entry in pending_decisions:
+    queue_decision(entry)
+threading.Thread(target=io_worker, daemon=True).start()
+
+# Background decoding: a small pool of workers and a bounded LRU of decoded images
+executor = ThreadPoolExecutor(max_workers=8 if grid_mode else 4)
+image_cache = OrderedDict()
+# In grid mode, a whole page is prefetched and the cache holds a few pages of thumbnails
+prefetch_count = GRID_ROWS * GRID_COLUMNS if grid_mode else PREFETCH_COUNT
+cache_size = 3 * GRID_ROWS * GRID_COLUMNS if grid_mode else CACHE_SIZE
+page_indices = []
+selected_tiles = set()
+# GPS positions, read in bulk with the cache shared with 30-photosToGeoJson.py
+gps_positions = executor.submit(read_gps_bulk, image_list)
+
 # Set up the GUI
 root = Tk()
 root.title('Image Viewer')
@@ -95,7 +387,16 @@ middle_frame = Frame(root)
 middle_frame.grid(row=1, column=0)
 
 image_label = Label(middle_frame)
-image_label.pack(expand=True)
+tiles = []
+if grid_mode:
+    for tile_number in range(GRID_ROWS * GRID_COLUMNS):
+        tile = Label(middle_frame, bd=4, text=GRID_KEYS[tile_number], compound='top')
+        tile.grid(row=tile_number // GRID_COLUMNS, column=tile_number % GRID_COLUMNS)
+        tile.image = None
+        tiles.append(tile)
+    tile_background = tiles[0].cget('bg')
+else:
+    image_label.pack(expand=True)
 
 # Bottom frame
 bottom_frame = Frame(root)
@@ -114,17 +415,42 @@ yes_button.grid(row=1, column=0)
 no_button = Button(bottom_frame, text='No', command=no_action)
 no_button.grid(row=1, column=1)
 
-# Bind the left and right arrow keys to the 'yes_action' and 'no_action' functions
-root.bind('<Left>', yes_action)  # Bind the left arrow key
-root.bind('<Right>', no_action)  # Bind the right arrow key
+undo_button = Button(bottom_frame, text='Undo', command=undo_action)
+undo_button.grid(row=2, column=0)
+
+io_label = Label(bottom_frame, text='')
+io_label.grid(row=2, column=1)
+
+if grid_mode:
+    question_label.config(text='Select the hiking signs, then confirm the page.')
+    yes_button.config(text='Confirm page', command=confirm_page)
+    no_button.grid_remove()
+    # Bind one key per tile and the return key to confirm the page
+    for tile_number, key in enumerate(GRID_KEYS[:len(tiles)]):
+        root.bind(key, lambda event, tile_number=tile_number: toggle_tile(tile_number))
+    root.bind('<Return>', confirm_page)
+else:
+    # Bind the left and right arrow keys to the 'yes_action' and 'no_action' functions
+    root.bind('<Left>', yes_action)  # Bind the left arrow key
+    root.bind('<Right>', no_action)  # Bind the right arrow key
+root.bind('<BackSpace>', undo_action)
 
 root.update()
 width = root.winfo_screenwidth()*0.85
 height = root.winfo_screenheight()*0.85
 img_size = (width, height)
+thumbnail_size = (width / GRID_COLUMNS - 16, height / GRID_ROWS - 32)  # Room for the border and the key label
 
-# Initialize the first image update
+# Start polling the file operations, then initialize the first image update
+poll_io()
 update_image()
 
 # Start the Tkinter event loop
-root.mainloop()
\ No newline at end of file
+root.mainloop()
+executor.shutdown(wait=False, cancel_futures=True)
+
+# Let the queued moves and copies finish before exiting
+if io_queue.unfinished_tasks:
+    print(f"Waiting for {io_queue.unfinished_tasks} file operations...")
+io_queue.join()
+journal.close()
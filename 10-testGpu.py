@@ -1,4 +1,9 @@
+import os
+import json
+import time
+import argparse
 import torch
+from deviceReport import REPORT_FILE, is_usable
 
 devices = [
     "cpu", "cuda", "ipu", "xpu", "mkldnn", "opengl", "opencl", "ideep", "hip", 
@@ -61,3 +66,117 @@ if not available_devices:
     print("No specified devices are available.")
 else:
     print("Available devices:", available_devices)
+
+
+# Benchmark the devices that can actually run the detectron2 pipeline
+detectron2_config = "./detectron2/configs/COCO-Detection/faster_rcnn_R_50_FPN_3x.yaml"
+benchmark_size = (800, 1216)  # Fixed input size of the R50-FPN forward pass (height, width)
+
+def synchronize(device):
+    if device == "cuda":
+        torch.cuda.synchronize()
+    elif device == "mps":
+        torch.mps.synchronize()
+
+def time_workload(run, device, repeat):
+    """
+    Return the median duration of run() in seconds, after one warm-up call.
+    """
+    run()
+    synchronize(device)
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        synchronize(device)
+        durations.append(time.perf_counter() - start)
+    return sorted(durations)[len(durations) // 2]
+
+def conv_matmul_workload(device):
+    conv = torch.nn.Conv2d(64, 64, 3, padding=1).to(device).eval()
+    images = torch.randn(4, 64, 128, 128, device=device)
+    a = torch.randn(1024, 1024, device=device)
+    b = torch.randn(1024, 1024, device=device)
+
+    def run():
+        with torch.no_grad():
+            conv(images)
+            a @ b
+    return run
+
+def r50_fpn_workload(device):
+    """
+    Return a forward pass of the R50-FPN used by scripts 20-22, or None if detectron2 is missing.
+
+    Weights are random, only the speed of the forward pass matters here.
+    """
+    try:
+        from detectron2.config import get_cfg
+        from detectron2.modeling import build_model
+    except ImportError:
+        return None
+    cfg = get_cfg()
+    cfg.merge_from_file(detectron2_config)
+    cfg.MODEL.WEIGHTS = ""
+    cfg.MODEL.MASK_ON = True
+    cfg.MODEL.DEVICE = device
+    model = build_model(cfg).eval()
+    height, width = benchmark_size
+    inputs = [{"image": torch.rand(3, height, width, device=device) * 255, "height": height, "width": width}]
+
+    def run():
+        with torch.no_grad():
+            model(inputs)
+    return run
+
+def benchmark_configurations(devices):
+    """
+    List the configurations to measure: every CPU thread count with mkldnn on and off, and each accelerator.
+    """
+    configurations = []
+    if "cpu" in devices:
+        cpu_count = os.cpu_count() or 1
+        thread_counts = sorted({1 << i for i in range(cpu_count.bit_length()) if 1 << i <= cpu_count} | {cpu_count})
+        for threads in thread_counts:
+            for mkldnn in (True, False):
+                if mkldnn and not torch.backends.mkldnn.is_available():
+                    continue
+                configurations.append({"device": "cpu", "threads": threads, "mkldnn": mkldnn})
+    for device in ("cuda", "mps", "xpu"):
+        if device in devices and is_usable(device):
+            configurations.append({"device": device, "threads": torch.get_num_threads(), "mkldnn": False})
+    return configurations
+
+def run_benchmarks(devices, repeat, with_detectron2):
+    results = []
+    default_threads = torch.get_num_threads()
+    for configuration in benchmark_configurations(devices):
+        device = configuration["device"]
+        torch.set_num_threads(configuration["threads"] if device == "cpu" else default_threads)
+        with torch.backends.mkldnn.flags(enabled=configuration["mkldnn"]):
+            result = dict(configuration)
+            result["conv_matmul_s"] = time_workload(conv_matmul_workload(device), device, repeat)
+            r50_fpn = r50_fpn_workload(device) if with_detectron2 else None
+            result["r50_fpn_s"] = time_workload(r50_fpn, device, repeat) if r50_fpn else None
+        message = f"{device} threads={result['threads']} mkldnn={result['mkldnn']}: conv+matmul {result['conv_matmul_s'] * 1000:.1f} ms"
+        if result["r50_fpn_s"]:
+            message += f", R50-FPN {result['r50_fpn_s'] * 1000:.1f} ms"
+        print(message)
+        results.append(result)
+    torch.set_num_threads(default_threads)
+    return results
+
+parser = argparse.ArgumentParser(description="List the torch devices and benchmark the usable ones.")
+parser.add_argument("--repeat", type=int, default=5, help="Timed runs per workload")
+parser.add_argument("--skip-detectron2", action="store_true", help="Only run the conv and matmul workload")
+parser.add_argument("--report", default=REPORT_FILE, help="JSON report read by the other scripts")
+args = parser.parse_args()
+
+results = run_benchmarks(available_devices, args.repeat, not args.skip_detectron2)
+if results:
+    # The R50-FPN pass is what scripts 20-22 run, rank on it when it was measured
+    metric = "r50_fpn_s" if all(result["r50_fpn_s"] for result in results) else "conv_matmul_s"
+    best = min(results, key=lambda result: result[metric])
+    with open(args.report, 'w') as f:
+        json.dump({"metric": metric, "best": {key: best[key] for key in ("device", "threads", "mkldnn")}, "results": results}, f, indent=2)
+    print(f"Fastest: {best['device']} with {best['threads']} threads, mkldnn {'on' if best['mkldnn'] else 'off'}. Report written to {args.report}")
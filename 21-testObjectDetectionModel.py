@@ -1,69 +1,33 @@
 import os
 import cv2
-import torch
+import argparse
 import tqdm
-from detectron2.config import get_cfg
 from detectron2.data import MetadataCatalog
-from detectron2.data.datasets import register_coco_instances
-from detectron2.engine import DefaultPredictor
 from detectron2.utils.visualizer import Visualizer, ColorMode
+from modelFactory import BACKENDS, get_predictor, model_hash, register_datasets
+from detectionsStore import file_sha1, read_detections, read_image_sha1s, rows_from_instances, to_instances, write_detections
 
-classes = ["top", "destination", "poster", "bike_sign", "street_sign", "panel", "compass"]
+parser = argparse.ArgumentParser(description="Visualize the predictions of the object detection model.")
+parser.add_argument("--backend", choices=BACKENDS, default="torch", help="Inference backend")
+parser.add_argument("--from-store", action="store_true", help="Draw the detections stored by script 22, run the model only for the other photos")
+args = parser.parse_args()
 
-# Définir les chemins
-train_set = "./coco-train"
-train_annotations = os.path.join(train_set, "result.json")
-
-test_set = "./coco-test"
-test_annotations = os.path.join(test_set, "result.json")
-
-# Register the dataset
-def register_dataset():
-    register_coco_instances("coco_train", {}, train_annotations, train_set)
-    register_coco_instances("coco_test", {}, test_annotations, test_set)
-
-    # Set metadata
-    MetadataCatalog.get("coco_train").set(
-        thing_classes=classes,
-        evaluator_type='coco',
-    )
-    MetadataCatalog.get("coco_test").set(
-        thing_classes=classes,
-        evaluator_type='coco',
-    )
-
-
-register_dataset()
+register_datasets("od")
 
 # Access the metadata catalog
 metadata = MetadataCatalog.get("coco_train")
 
-# Configuration
-cfg = get_cfg()
-cfg.OUTPUT_DIR = "./model-od"
-
-cfg.merge_from_file("./detectron2/configs/COCO-Detection/faster_rcnn_R_50_FPN_3x.yaml")
-#cfg.MODEL.WEIGHTS = "detectron2://COCO-Detection/faster_rcnn_R_50_FPN_3x/137849458/model_final_280758.pkl"
-cfg.MODEL.WEIGHTS = os.path.join(cfg.OUTPUT_DIR, "model_final.pth")
+# Detections of the current model and backend stored by script 22, by image name
+stored = {}
+if args.from_store:
+    model_key = model_hash("od", args.backend)
+    stored = read_detections(model=model_key)
+    stored_sha1s = read_image_sha1s(model=model_key)
+    print(f"{len(stored)} photos in the detections store")
+new_rows = {}  # Rows of the photos run through the model, added to the store at the end
 
-cfg.MODEL.ROI_HEADS.BATCH_SIZE_PER_IMAGE = 128
-cfg.MODEL.ROI_HEADS.NUM_CLASSES = len(classes)
-cfg.MODEL.DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
-cfg.MODEL.MASK_ON = True
-
-cfg.DATASETS.TRAIN = ("coco_train",)
-cfg.DATASETS.TEST = ("coco_test",)
-
-cfg.SOLVER.IMS_PER_BATCH = 2
-cfg.SOLVER.BASE_LR = 0.02
-cfg.SOLVER.STEPS = (4200, 5000)
-cfg.SOLVER.MAX_ITER = 5400
-
-cfg.DATALOADER.NUM_WORKERS = 4
-
-
-# Create the predictor
-predictor = DefaultPredictor(cfg)
+# Create the predictor, only when some photo is not in the store
+predictor = None if args.from_store else get_predictor("od", args.backend)
 
 # Create output folder for visualizations
 output_vis_folder = "./vis-od"
@@ -73,8 +37,15 @@ os.makedirs(output_vis_folder, exist_ok=True)
 def visualize_predictions(folder_path, filename, predictor, output_folder):
     image_path = os.path.join(folder_path, filename)
     image = cv2.imread(image_path)
-    outputs = predictor(image)
-    instances = outputs["instances"].to("cpu")
+    sha1 = file_sha1(image_path) if args.from_store else None
+    # The stored rows are used only if the photo was not replaced since
+    if filename in stored and stored_sha1s[filename] == sha1:
+        instances = to_instances(stored[filename], image.shape[:2])
+    else:
+        outputs = (predictor or get_predictor("od", args.backend))(image)
+        instances = outputs["instances"].to("cpu")
+        if args.from_store:
+            new_rows[filename] = rows_from_instances(filename, sha1, model_key, instances)
     instances = instances[instances.scores > 0.7]  # Filter instances by score
     # Skip if no instances are detected with score > 0.7
     if len(instances) == 0:
@@ -101,8 +72,11 @@ def evaluate_with_visualization(folder_path, predictor, output_folder):
 evaluate_with_visualization("photos/HikingSigns", predictor, output_vis_folder)
 
 # COCO evaluation
-#evaluator = COCOEvaluator("coco_train", cfg, False, output_dir="./output-viz/")
-#val_loader = build_detection_test_loader(cfg, "coco_train")
+#evaluator = COCOEvaluator("coco_train", predictor.cfg, False, output_dir="./output-viz/")
+#val_loader = build_detection_test_loader(predictor.cfg, "coco_train")
 #inference_on_dataset(predictor.model, val_loader, evaluator)
 
+if new_rows:
+    write_detections(new_rows)
+
 print("Model evaluation and visualization completed.")
@@ -1,36 +1,32 @@
 import os
 import cv2
-import torch
+import json
+import time
+import queue
+import threading
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
 from tqdm import tqdm
-from detectron2.engine import DefaultPredictor
-from detectron2.config import get_cfg
+from PIL import Image
+import argparse
 import numpy as np
-
-classes = ["top", "destination", "poster", "bike_sign", "street_sign", "panel"]
-
-# Configuration
-cfg = get_cfg()
-cfg.OUTPUT_DIR = "./model-od"
-
-cfg.merge_from_file("./detectron2/configs/COCO-Detection/faster_rcnn_R_50_FPN_3x.yaml")
-cfg.MODEL.WEIGHTS = "detectron2://COCO-Detection/faster_rcnn_R_50_FPN_3x/137849458/model_final_280758.pkl"
-cfg.MODEL.WEIGHTS = os.path.join(cfg.OUTPUT_DIR, "model_final.pth")
-cfg.MODEL.ROI_HEADS.BATCH_SIZE_PER_IMAGE = 128
-cfg.MODEL.ROI_HEADS.NUM_CLASSES = len(classes)
-cfg.MODEL.DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
-cfg.MODEL.MASK_ON = True
-
-cfg.DATASETS.TRAIN = ("hiking_signs_train",)
-cfg.DATASETS.TEST = ("hiking_signs_test",)
-
-cfg.SOLVER.IMS_PER_BATCH = 2
-cfg.SOLVER.BASE_LR = 0.02
-cfg.SOLVER.STEPS = (4200, 5000)
-cfg.SOLVER.MAX_ITER = 5400
-
-cfg.DATALOADER.NUM_WORKERS = 4
-
-predictor = DefaultPredictor(cfg)
+from modelFactory import BACKENDS, get_predictor, predict_batch
+from detectionsStore import DESTINATION_CLASS, TOP_CLASS, file_sha1, read_detections, rows_from_instances, write_detections
+from exifGps import atomic_write
+
+BATCH_SIZE = 4  # Images per model call
+GROUP_WINDOW = 4  # Batches read ahead to group the images by aspect ratio
+DECODE_WORKERS = 4  # Threads reading the photos
+CROP_WORKERS = 4  # Threads warping and writing the crops
+SCORE_THRESHOLD = 0.7  # Only crop the instances scored above it
+REDUCE = 1  # Decode the photos at 1/REDUCE of their size for the model, 1, 2 or 4
+QUAD_METHOD = "rect"  # Corners of the crops: "rect" for the minimum area rectangle, "poly" for a fitted quadrilateral
+MANIFEST_FILE = "crop/manifest.json"
+MANIFEST_SAVE_EVERY = 50  # Photos processed between two saves of the manifest
+
+# cv2.imread flags decoding a JPEG directly at 1/1, 1/2 or 1/4 of its size, by DCT scaling
+REDUCED_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4}
 
 def create_crop_folders():
     if not os.path.exists('crop/top'):
@@ -38,22 +34,52 @@ def create_crop_folders():
     if not os.path.exists('crop/destination'):
         os.makedirs('crop/destination')
 
-def get_perspective_corners(mask):
+def get_perspective_corners(mask, bbox=None, method=QUAD_METHOD):
     """
-    Extract the four corners of the mask and return them.
+    Extract the four corners of the mask and return them, or None if the mask is empty.
 
     This function finds the contours of the mask, identifies the largest contour, and computes the minimum area 
     rectangle that encloses the contour. It then extracts the four corners of this rectangle and returns them.
+    With method "poly", the corners are those of a quadrilateral fitted to the contour instead, which follows
+    the perspective of a sign seen at an angle.
+
+    When the predicted box (x0, y0, x1, y1) is given, only this region of the mask is scanned, so a
+    small sign in a 12 MP photo does not cost a full-frame copy and contour search.
     """
+    # Restrict the search to the box, rounded outwards with a pixel of margin
+    height, width = mask.shape[:2]
+    x0, y0, x1, y1 = 0, 0, width, height
+    if bbox is not None:
+        x0 = max(int(bbox[0]) - 1, 0)
+        y0 = max(int(bbox[1]) - 1, 0)
+        x1 = min(int(np.ceil(bbox[2])) + 1, width)
+        y1 = min(int(np.ceil(bbox[3])) + 1, height)
+    roi = mask[y0:y1, x0:x1]  # A view, no copy of the full mask
+
     # Find the contours of the mask using cv2.findContours
-    # mask.astype(np.uint8) converts the mask to an 8-bit single-channel image
+    # roi.astype(np.uint8) converts the region to an 8-bit single-channel image
     # cv2.RETR_EXTERNAL retrieves only the external contours
     # cv2.CHAIN_APPROX_SIMPLE compresses horizontal, vertical, and diagonal segments and leaves only their end points
-    contours, _ = cv2.findContours(mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    # offset shifts the contour points back to the coordinates of the full image
+    contours, _ = cv2.findContours(roi.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(x0, y0))
+    if not contours:
+        return None
 
     # Find the largest contour based on the area using max
     contour = max(contours, key=cv2.contourArea)
 
+    if method == "poly":
+        # Simplify the convex hull more and more until only four corners are left
+        hull = cv2.convexHull(contour)
+        perimeter = cv2.arcLength(hull, True)
+        for epsilon in np.linspace(0.01, 0.1, 10):
+            quad = cv2.approxPolyDP(hull, epsilon * perimeter, True)
+            if len(quad) == 4:
+                return np.intp(quad.reshape(4, 2))
+            if len(quad) < 4:
+                break
+        # Not a quadrilateral, fall back to the rectangle
+
     # Compute the minimum area rectangle that can enclose the largest contour
     rect = cv2.minAreaRect(contour)
 
@@ -164,38 +190,384 @@ def draw_and_label_corners(image, box):
     cv2.waitKey(0)
     cv2.destroyAllWindows()
 
-def crop_and_save(image_path, predictor):
-    image = cv2.imread(image_path)
-    if image is None:
-        print(f"Error: Unable to load image at {image_path}")
-        return
-    outputs = predictor(image)
-    instances = outputs["instances"].to("cpu")
-    masks = instances.pred_masks if instances.has("pred_masks") else None
-    classes = instances.pred_classes
-    scores = instances.scores
-
-    if masks is not None:
-        for i, (mask, cls, score) in enumerate(zip(masks, classes, scores)):
-            if score > 0.7:  # Only crop if prediction score is greater than 70%
-                box = get_perspective_corners(mask.numpy())
-                #draw_image(image, box, mask)
-                #draw_and_label_corners(image, box)
-                corrected_image = correct_perspective(image, box)
-                #draw_image(corrected_image, None, None)
-                if cls == 5:  # Top part
-                    crop_path = f"crop/top/{os.path.splitext(os.path.basename(image_path))[0]}_top_{i+1}.jpg"
-                elif cls == 1:  # Destination board
-                    crop_path = f"crop/destination/{os.path.splitext(os.path.basename(image_path))[0]}_destination_{i+1}.jpg"
-                else:
-                    continue  # Skip other classes
-                cv2.imwrite(crop_path, corrected_image)
-
-def process_new_images(folder_path, predictor):
+class CropManifest:
+    """
+    Record of the detections and crops of each photo, stored in crop/manifest.json.
+
+    For every photo it keeps the size, mtime and SHA-1 of the file, the key of the model (see modelFactory.model_hash),
+    the reduction of the decode it ran on, the score threshold, every top/destination detection with the corners used to crop it, and the
+    crops written. The crop workers update it concurrently, hence the lock.
+    """
+    def __init__(self, path=MANIFEST_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = {"photos": {}}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.data = json.load(f)
+        self.unsaved = 0
+
+    def is_done(self, image_path, model_hash, threshold, method, reduce):
+        """
+        True if the photo did not change since it was cropped with this model, reduction, threshold and corner method.
+        """
+        entry = self.data["photos"].get(os.path.basename(image_path))
+        if not entry or entry["model"] != model_hash or entry["threshold"] != threshold or entry.get("quad", "rect") != method:
+            return False
+        if entry.get("reduce", 1) != reduce:
+            return False
+        stat = os.stat(image_path)
+        if entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+            return False
+        return all(os.path.exists(crop["path"]) for crop in entry["crops"])
+
+    def cached_detections(self, image_path, sha1, model_hash, method, reduce):
+        """
+        Return the detections of a photo with this content, model, reduction and corner method, or None if it must be detected again.
+        """
+        entry = self.data["photos"].get(os.path.basename(image_path))
+        if entry and entry["sha1"] == sha1 and entry["model"] == model_hash and entry.get("quad", "rect") == method and entry.get("reduce", 1) == reduce:
+            return entry["detections"]
+        return None
+
+    def update(self, image_path, sha1, model_hash, threshold, method, reduce, detections, crops):
+        stat = os.stat(image_path)
+        with self.lock:
+            key = os.path.basename(image_path)
+            previous = self.data["photos"].get(key)
+            # Remove the crops of a previous run that are not produced anymore
+            if previous:
+                kept = {crop["path"] for crop in crops}
+                for crop in previous["crops"]:
+                    if crop["path"] not in kept and os.path.exists(crop["path"]):
+                        os.remove(crop["path"])
+            self.data["photos"][key] = {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "sha1": sha1,
+                "model": model_hash,
+                "threshold": threshold,
+                "quad": method,
+                "reduce": reduce,
+                "detections": detections,
+                "crops": crops,
+            }
+            self.unsaved += 1
+            if self.unsaved >= MANIFEST_SAVE_EVERY:
+                self._save()
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        with atomic_write(self.path) as f:
+            json.dump(self.data, f)
+        self.unsaved = 0
+
+def detections_from_instances(instances, method=QUAD_METHOD):
+    """
+    Keep the top and destination instances, with the corners used to crop them.
+
+    Instances are kept whatever their score, so that the crops can be derived again for another
+    threshold without running the model.
+    """
+    instances = instances.to("cpu")
+    detections = []
+    if not instances.has("pred_masks"):
+        return detections
+    for i, (mask, bbox, cls, score) in enumerate(zip(instances.pred_masks, instances.pred_boxes.tensor, instances.pred_classes, instances.scores)):
+        if int(cls) not in (TOP_CLASS, DESTINATION_CLASS):
+            continue  # Skip other classes
+        box = get_perspective_corners(mask.numpy(), bbox.tolist(), method)
+        if box is None:
+            continue  # Skip empty masks
+        #draw_image(image, box, mask)
+        #draw_and_label_corners(image, box)
+        detections.append({
+            "instance": i,
+            "class": int(cls),
+            "score": float(score),
+            "bbox": [round(float(v), 1) for v in bbox],
+            "quad": box.tolist(),
+        })
+    return detections
+
+def crop_detections(image_path, image, detections, threshold):
+    base_filename = os.path.splitext(os.path.basename(image_path))[0]
+    crops = []
+    for detection in detections:
+        if detection["score"] > threshold:  # Only crop if prediction score is greater than the threshold
+            corrected_image = correct_perspective(image, np.array(detection["quad"]))
+            #draw_image(corrected_image, None, None)
+            if detection["class"] == TOP_CLASS:  # Top part
+                crop_path = f"crop/top/{base_filename}_top_{detection['instance']+1}.jpg"
+            else:  # Destination board
+                crop_path = f"crop/destination/{base_filename}_destination_{detection['instance']+1}.jpg"
+            cv2.imwrite(crop_path, corrected_image)
+            crops.append({key: detection[key] for key in ("instance", "class", "score", "bbox")} | {"path": crop_path})
+    return crops
+
+# Function to read the (height, width) of a photo from its header, after the EXIF rotation cv2.imread applies
+def original_size(image_path):
+    with Image.open(image_path) as image:
+        width, height = image.size
+        if image.getexif().get(0x0112, 1) in (5, 6, 7, 8):  # Rotated by 90 or 270 degrees
+            width, height = height, width
+    return height, width
+
+def load_for_detection(image_path, reduce):
+    """
+    Decode a photo for the model and return it with the (height, width) of the original photo.
+
+    With reduce 2 or 4, libjpeg decodes a smaller image directly, which takes a fraction of the
+    time and memory of the full decode. The model still returns boxes and masks at the size of
+    the original photo, so the crops are warped from the original pixels.
+    """
+    image = cv2.imread(image_path, REDUCED_FLAGS[reduce])
+    if image is None or reduce == 1:
+        return image, None if image is None else image.shape[:2]
+    return image, original_size(image_path)
+
+# Function to get the manifest detections of a photo, only if the store also has its instances
+def cached_detections(image_path, sha1, context):
+    if os.path.basename(image_path) not in context["stored"]:
+        return None
+    return context["manifest"].cached_detections(image_path, sha1, context["model_hash"], context["quad"], context["reduce"])
+
+# Function to crop a decoded photo from its model outputs or its cached detections
+def crop_and_record(image_path, image, sha1, instances, detections, context):
+    if detections is None:
+        instances = instances.to("cpu")
+        detections = detections_from_instances(instances, context["quad"])
+        # Every instance goes to the detections store, for scripts 21, 30 and 91
+        rows = rows_from_instances(os.path.basename(image_path), sha1, context["store_model"], instances)
+        with context["rows_lock"]:
+            context["rows"][os.path.basename(image_path)] = rows
+    # The model saw a reduced image, or no image for cached detections: warp from the original pixels
+    if (image is None or context["reduce"] > 1) and any(d["score"] > context["threshold"] for d in detections):
+        image = cv2.imread(image_path)
+        if image is None:
+            raise ValueError(f"Unable to load image at {image_path}")
+    crops = crop_detections(image_path, image, detections, context["threshold"])
+    context["manifest"].update(image_path, sha1, context["model_hash"], context["threshold"], context["quad"], context["reduce"], detections, crops)
+
+def crop_and_save(image_path, predictor, context):
+    sha1 = file_sha1(image_path)
+    detections = cached_detections(image_path, sha1, context)
+    image, instances = None, None
+    if detections is None:
+        image, full_size = load_for_detection(image_path, context["reduce"])
+        if image is None:
+            print(f"Error: Unable to load image at {image_path}")
+            return
+        instances = predict_batch(predictor, [image], [full_size])[0]["instances"]
+    try:
+        crop_and_record(image_path, image, sha1, instances, detections, context)
+    except ValueError as e:
+        print(f"Error: {e}")
+
+def split_by_aspect_ratio(items, batch_size):
+    items = sorted(items, key=lambda item: item[1].shape[1] / item[1].shape[0])
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
+
+def group_by_aspect_ratio(items, batch_size):
+    """
+    Yield batches of up to batch_size (path, image, ...) items with similar aspect ratios.
+
+    GROUP_WINDOW batches worth of images are read ahead and sorted by aspect ratio, so that
+    portrait and landscape photos are not padded to the same square-ish batch tensor.
+    """
+    window = []
+    for item in items:
+        window.append(item)
+        if len(window) == batch_size * GROUP_WINDOW:
+            yield from split_by_aspect_ratio(window, batch_size)
+            window = []
+    yield from split_by_aspect_ratio(window, batch_size)
+
+class StageTimer:
+    """
+    Busy time and item count of each pipeline stage, shared by the worker threads.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seconds = defaultdict(float)
+        self.items = defaultdict(int)
+
+    @contextmanager
+    def measure(self, stage, items=1):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.seconds[stage] += time.perf_counter() - start
+                self.items[stage] += items
+
+    def report(self, wall_seconds):
+        for stage in self.seconds:
+            items = max(self.items[stage], 1)
+            print(f"{stage}: {self.items[stage]} items, {self.seconds[stage]:.1f} s busy, {self.seconds[stage] / items * 1000:.0f} ms/item")
+        print(f"Model busy {100 * self.seconds['inference'] / max(wall_seconds, 1e-9):.0f}% of {wall_seconds:.1f} s")
+
+# Marker put in a queue by a worker that has no more items
+DONE = None
+
+def decode_worker(paths, decoded, to_crop, context, timer, progress):
+    try:
+        while True:
+            image_path = paths.get()
+            if image_path is DONE:
+                return
+            try:
+                with timer.measure("decode"):
+                    sha1 = file_sha1(image_path)
+                    detections = cached_detections(image_path, sha1, context)
+                    if detections is None:
+                        image, full_size = load_for_detection(image_path, context["reduce"])
+            except Exception as e:
+                print(f"Error: Unable to read {image_path} => {e}")
+                progress.update(1)
+                continue
+            if detections is not None:
+                to_crop.put((image_path, None, sha1, None, detections))  # Same photo and model, decoded by the crop stage if needed
+            elif image is None:
+                print(f"Error: Unable to load image at {image_path}")
+                progress.update(1)
+            else:
+                decoded.put((image_path, image, sha1, full_size))  # Blocks while the inference stage is behind
+    finally:
+        decoded.put(DONE)  # Even if the worker dies, so that drain() does not wait forever
+
+def crop_worker(to_crop, context, timer, progress):
+    while True:
+        item = to_crop.get()
+        if item is DONE:
+            return
+        try:
+            with timer.measure("crop"):
+                crop_and_record(*item, context)
+        except Exception as e:
+            print(f"Error: Unable to crop {item[0]} => {e}")
+        progress.update(1)
+
+# Function to read the decoded images until every decode worker is done
+def drain(decoded, producers):
+    while producers:
+        item = decoded.get()
+        if item is DONE:
+            producers -= 1
+        else:
+            yield item
+
+def run_pipeline(image_paths, predictor, batch_size, context):
+    """
+    Decode, detect and crop in three stages connected by bounded queues.
+
+    DECODE_WORKERS threads read the photos, the calling thread runs the model on batches,
+    and CROP_WORKERS threads warp and write the crops. A full queue blocks the stage that
+    feeds it, so at most a few batches of decoded photos are held in memory. Photos with
+    cached detections go straight from the decode stage to the crop stage.
+    """
+    timer = StageTimer()
+    paths = queue.Queue()
+    for image_path in image_paths:
+        paths.put(image_path)
+    for _ in range(DECODE_WORKERS):
+        paths.put(DONE)
+    decoded = queue.Queue(maxsize=batch_size * GROUP_WINDOW)
+    to_crop = queue.Queue(maxsize=batch_size * 2)
+
+    start = time.perf_counter()
+    with tqdm(total=len(image_paths), desc="Processing images") as progress:
+        workers = [threading.Thread(target=decode_worker, args=(paths, decoded, to_crop, context, timer, progress), daemon=True) for _ in range(DECODE_WORKERS)]
+        workers += [threading.Thread(target=crop_worker, args=(to_crop, context, timer, progress), daemon=True) for _ in range(CROP_WORKERS)]
+        for worker in workers:
+            worker.start()
+
+        for batch in group_by_aspect_ratio(drain(decoded, DECODE_WORKERS), batch_size):
+            with timer.measure("inference", len(batch)):
+                outputs = predict_batch(predictor, [item[1] for item in batch], [item[3] for item in batch])
+            for (image_path, image, sha1, _), output in zip(batch, outputs):
+                to_crop.put((image_path, image, sha1, output["instances"].to("cpu"), None))
+
+        for _ in range(CROP_WORKERS):
+            to_crop.put(DONE)
+        for worker in workers:
+            worker.join()
+    timer.report(time.perf_counter() - start)
+
+# Function to get the model key of the store rows, which tells the detections of reduced decodes apart
+def store_model_key(model_hash, reduce):
+    return f"{model_hash}:reduce{reduce}" if reduce > 1 else model_hash
+
+def process_new_images(folder_path, predictor, batch_size=1, threshold=SCORE_THRESHOLD, quad=QUAD_METHOD, reduce=REDUCE):
     create_crop_folders()
+    manifest = CropManifest()
+    model_hash = predictor.model_hash  # Backend and SHA-1 of the loaded model file
+    store_model = store_model_key(model_hash, reduce)
+    context = {
+        "manifest": manifest,
+        "model_hash": model_hash,
+        "store_model": store_model,
+        "threshold": threshold,
+        "quad": quad,
+        "reduce": reduce,
+        "stored": set(read_detections(columns=["image"], model=store_model)),
+        "rows": {},  # Store rows of the photos run through the model, by image name
+        "rows_lock": threading.Lock(),
+    }
     filenames = [f for f in os.listdir(folder_path) if f.endswith(".jpg")]
-    for filename in tqdm(filenames, desc="Processing images"):
-        image_path = os.path.join(folder_path, filename)
-        crop_and_save(image_path, predictor)
-
-process_new_images("./photos/HikingSigns", predictor)
+    image_paths = [os.path.join(folder_path, filename) for filename in filenames]
+    # Photos already cropped with the same content, model, reduction, threshold and corners are not even read,
+    # unless their instances are missing from the detections store
+    pending = [p for p in image_paths if not manifest.is_done(p, model_hash, threshold, quad, reduce) or os.path.basename(p) not in context["stored"]]
+    print(f"{len(image_paths) - len(pending)} photos unchanged, {len(pending)} to process")
+
+    try:
+        if batch_size <= 1:
+            for image_path in tqdm(pending, desc="Processing images"):
+                crop_and_save(image_path, predictor, context)
+        else:
+            run_pipeline(pending, predictor, batch_size, context)
+    finally:
+        manifest.save()
+        if context["rows"]:
+            write_detections(context["rows"])
+
+def benchmark_corners(repeat=20):
+    """
+    Print the time and peak memory per instance of get_perspective_corners on a synthetic 12 MP mask.
+    """
+    filled = np.zeros((3000, 4000), dtype=np.uint8)
+    quad = np.array([[1800, 1200], [2300, 1250], [2280, 1500], [1790, 1430]], dtype=np.int32)  # A sign seen at an angle
+    cv2.fillPoly(filled, [quad], 1)
+    mask = filled.astype(bool)
+    bbox = [*quad.min(axis=0), *(quad.max(axis=0) + 1)]
+    for name, box, method in (("full frame, rect", None, "rect"), ("box ROI, rect", bbox, "rect"), ("box ROI, poly", bbox, "poly")):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            corners = get_perspective_corners(mask, box, method)
+        seconds = (time.perf_counter() - start) / repeat
+        # Peak of the numpy allocations, measured apart as tracing slows the calls down
+        tracemalloc.start()
+        get_perspective_corners(mask, box, method)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{name}: {seconds * 1000:.2f} ms, peak {peak / 1e6:.2f} MB, corners {corners.tolist()}")
+
+parser = argparse.ArgumentParser(description="Crop the top and destination parts of the guideposts.")
+parser.add_argument("--backend", choices=BACKENDS, default="torch", help="Inference backend")
+parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Images per model call, 1 for the one-by-one loop")
+parser.add_argument("--threshold", type=float, default=SCORE_THRESHOLD, help="Minimum score of the instances to crop")
+parser.add_argument("--reduce", type=int, choices=sorted(REDUCED_FLAGS), default=REDUCE, help="Run the model on the photos decoded at 1/2 or 1/4 of their size")
+parser.add_argument("--quad", choices=["rect", "poly"], default=QUAD_METHOD, help="Corners of the crops: minimum area rectangle or fitted quadrilateral")
+parser.add_argument("--benchmark-corners", action="store_true", help="Time the corner extraction per instance and exit")
+args = parser.parse_args()
+
+if args.benchmark_corners:
+    benchmark_corners()
+else:
+    process_new_images("./photos/HikingSigns", get_predictor("od", args.backend), args.batch_size, args.threshold, args.quad, args.reduce)
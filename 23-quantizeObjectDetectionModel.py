@@ -0,0 +1,135 @@
+import os
+import sys
+import time
+import glob
+import json
+import random
+import argparse
+import numpy as np
+import torch
+from detectron2.data import build_detection_test_loader
+from detectron2.data.detection_utils import read_image
+from detectron2.engine import DefaultPredictor
+from detectron2.evaluation import COCOEvaluator, inference_on_dataset
+from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_dynamic, quantize_static
+from onnxruntime.quantization.shape_inference import quant_pre_process
+from modelFactory import ExportedPredictor, OnnxPredictor, ONNX_PROVIDERS, build_cfg, get_predictor, onnx_path, preprocess, register_datasets
+
+CALIBRATION_IMAGES = 100  # Images of coco-train used to calibrate the static quantization
+LATENCY_IMAGES = 20  # Images of coco-test timed for the report
+MAX_AP_DROP = 1.0  # AP points the quantized model may lose on coco_test, for bbox and segm
+REPORT_FILE = "./model-od/quantization_report.json"
+
+# Feed preprocessed coco-train images to the static quantization calibration
+class CocoCalibrationReader(CalibrationDataReader):
+    def __init__(self, cfg, folder, count):
+        paths = sorted(glob.glob(os.path.join(folder, "images", "*.jpg")))
+        random.Random(0).shuffle(paths)
+        self.paths = iter(paths[:count])
+        self.resizer = ExportedPredictor(cfg)  # Same resize and color format as inference
+
+    def get_next(self):
+        path = next(self.paths, None)
+        if path is None:
+            return None
+        return {"image": preprocess(self.resizer, read_image(path, format="BGR"))["image"].numpy()}
+
+# Resident memory of this process in MB, from /proc on Linux
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except (OSError, ValueError):
+        return 0.0
+
+def quantize(mode, cfg, source, destination):
+    # Shape inference and graph cleanup, recommended by ONNX Runtime before quantizing
+    prepared = destination + ".prepared.onnx"
+    quant_pre_process(source, prepared)
+    try:
+        if mode == "dynamic":
+            # Weights in INT8, activations quantized on the fly: no calibration, mostly helps the heads
+            quantize_dynamic(prepared, destination, weight_type=QuantType.QInt8)
+        else:
+            # Weights and activations in INT8 with ranges calibrated on coco-train: also covers the convolutions of the backbone
+            reader = CocoCalibrationReader(cfg, "./coco-train", CALIBRATION_IMAGES)
+            quantize_static(prepared, destination, reader, quant_format=QuantFormat.QDQ,
+                            activation_type=QuantType.QInt8, weight_type=QuantType.QInt8, per_channel=True)
+    finally:
+        os.remove(prepared)
+
+def evaluate(name, load_predictor, cfg):
+    """
+    Return the COCOEvaluator results of a predictor on coco_test, with its latency and memory.
+
+    The memory is the growth of the resident memory from loading the predictor to the end of
+    the evaluation.
+    """
+    rss_before = rss_mb()
+    predictor = load_predictor()
+    # The test loader already resizes the images, the exported predictors take float tensors
+    if isinstance(predictor, ExportedPredictor):
+        model = lambda inputs: predictor.predict_inputs([dict(i, image=i["image"].float()) for i in inputs])
+    else:
+        model = predictor.model
+    evaluator = COCOEvaluator("coco_test", cfg, False, output_dir=f"./output-quantization/{name}/")
+    results = inference_on_dataset(model, build_detection_test_loader(cfg, "coco_test"), evaluator)
+
+    paths = sorted(glob.glob(os.path.join("./coco-test", "images", "*.jpg")))[:LATENCY_IMAGES]
+    latencies = []
+    for path in paths:
+        image = read_image(path, format="BGR")
+        start = time.perf_counter()
+        predictor(image)
+        latencies.append(time.perf_counter() - start)
+    return {
+        "bbox_ap": results["bbox"]["AP"],
+        "segm_ap": results["segm"]["AP"] if "segm" in results else None,
+        "latency_ms": round(float(np.median(latencies)) * 1000, 1),
+        "rss_mb": round(rss_mb() - rss_before, 1),
+    }
+
+parser = argparse.ArgumentParser(description="Quantize the ONNX object detection model to INT8 and publish it if its AP holds.")
+parser.add_argument("--mode", choices=["static", "dynamic"], default="static", help="Post-training quantization mode")
+parser.add_argument("--max-ap-drop", type=float, default=MAX_AP_DROP, help="AP points the INT8 model may lose before it is refused")
+args = parser.parse_args()
+
+register_datasets("od")
+cfg = build_cfg("od")
+cfg.MODEL.DEVICE = "cpu"  # The quantized model is for the CPU nodes
+if not os.path.exists(onnx_path("od")):
+    sys.exit(f"{onnx_path('od')} not found, run: python modelFactory.py --export od --format onnx")
+
+# Quantize to a candidate file, renamed to the published path only if it passes the AP gate
+candidate = onnx_path("od", int8=True) + ".candidate"
+quantize(args.mode, cfg, onnx_path("od"), candidate)
+
+report = {"mode": args.mode, "max_ap_drop": args.max_ap_drop, "variants": {}}
+# The torch reference runs on the CPU too, get_predictor would follow the device report
+variants = {
+    "torch": (lambda: DefaultPredictor(cfg), cfg.MODEL.WEIGHTS),
+    "onnx": (lambda: get_predictor("od", "onnx"), onnx_path("od")),
+    f"onnx-int8-{args.mode}": (lambda: OnnxPredictor(cfg, candidate, ONNX_PROVIDERS["onnx-int8"]), candidate),
+}
+for name, (load_predictor, path) in variants.items():
+    with torch.no_grad():
+        report["variants"][name] = evaluate(name, load_predictor, cfg) | {"size_mb": round(os.path.getsize(path) / 1e6, 1)}
+
+for name, variant in report["variants"].items():
+    print(f"{name}: bbox AP {variant['bbox_ap']:.2f}, segm AP {variant['segm_ap'] or 0:.2f}, "
+          f"{variant['latency_ms']} ms/image, +{variant['rss_mb']} MB RSS, {variant['size_mb']} MB on disk")
+
+# Gate on the drop from the trained model for both the boxes and the masks
+reference, quantized = report["variants"]["torch"], report["variants"][f"onnx-int8-{args.mode}"]
+drops = [reference[key] - quantized[key] for key in ("bbox_ap", "segm_ap") if reference[key] is not None]
+report["published"] = max(drops) <= args.max_ap_drop
+with open(REPORT_FILE, 'w') as f:
+    json.dump(report, f, indent=2)
+
+if report["published"]:
+    os.replace(candidate, onnx_path("od", int8=True))
+    print(f"AP drop {max(drops):.2f} <= {args.max_ap_drop}, published {onnx_path('od', int8=True)}")
+else:
+    os.remove(candidate)
+    print(f"AP drop {max(drops):.2f} > {args.max_ap_drop}, quantized model refused")
+    sys.exit(1)
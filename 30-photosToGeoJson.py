@@ -1,12 +1,23 @@
 import os
 import json
+import time
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import functools
+import multiprocessing
+from collections import defaultdict
+import httpx
 import easyocr
 import geojson
 import toml
 import ollama
-from exif import Image as ExifImage
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from detectionsStore import DESTINATION_CLASS, TOP_CLASS, file_sha1, read_detections, read_image_sha1s
+from exifGps import atomic_write, read_gps_bulk
 
 enable_ocr = False
 enable_llm = True
@@ -14,6 +25,29 @@ llm_model = "llama3.2-vision"
 llm_model = "minicpm-v"
 llm_model = "benzie/llava-phi-3"
 llm_model = "moondream"
+llm_host = os.environ.get("OLLAMA_HOST", "http://127.0.0.1:11434")  # Ollama server, or any server speaking its API
+llm_concurrency = 4  # Requests in flight, up to the OLLAMA_NUM_PARALLEL slots of the server
+llm_timeout = 120  # Seconds per request
+llm_retries = 3  # Retries of a failed request, after 1, 2, 4... seconds
+ocr_languages = ['fr']
+ocr_batched = True  # Batched OCR in worker processes, False for the former threads sharing one reader
+ocr_cpu_workers = 2  # Worker processes without GPU; with GPUs, one per GPU
+ocr_batch_size = 16  # Crops per readtext_batched call
+ocr_height = 256  # Height the crops of a batch are resized to, the width follows their aspect ratio
+
+# Transcriptions already computed, by crop content, engine, model and prompt
+transcription_cache_file = "transcriptions.sqlite"
+transcription_cache_max_mb = 64  # Least recently used transcriptions are evicted beyond it
+
+# Report of the geovisio upload, and its path -> (id, hd_href) index cached as JSON
+geovisio_toml = "./photos/HikingSigns/_geovisio.toml"
+geovisio_index = "./photos/HikingSigns/_geovisio_index.json"
+
+# Weights of the object detection model, whose detections are read from the store
+od_weights = "./model-od/model_final.pth"
+# Key of the store rows to read, see modelFactory.model_hash, e.g. "onnx-int8:<sha1>" after 22 --backend onnx-int8;
+# None for the torch rows of od_weights
+od_model = None
 
 llm_prompt_top = "Extract and correct the french text from this image. Do not add any additional text. Just output the text you manage to read."
 llm_prompt_dest = "Extract and correct the french text from this image. Do not add any additional text. Just output the text you manage to read."
@@ -26,55 +60,339 @@ def convert_uuid_to_url(uuid_string):
     url = f"{base_url}/{segments[0]}/{segments[1]}/{segments[2]}/{segments[3]}/{segments[4]}.jpg"
     return url
 
-def getPanoramax(filename):
+@functools.lru_cache(maxsize=None)
+def load_panoramax_index(toml_file_path=geovisio_toml, index_path=geovisio_index):
+    """
+    Return {picture path: (id, hd_href)} for the pictures of the geovisio report.
+
+    The TOML file is parsed once and the index saved as JSON, which is reused as long as the
+    mtime of the TOML file does not change. Cached for the process, so the worker threads share it.
+    """
+    if not os.path.exists(toml_file_path):
+        print(f"Error: {toml_file_path} not found, no Panoramax links.")
+        return {}
+    mtime_ns = os.stat(toml_file_path).st_mtime_ns
+    if os.path.exists(index_path):
+        with open(index_path, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+        if cached["mtime_ns"] == mtime_ns:
+            return {path: tuple(pic) for path, pic in cached["pictures"].items()}
+
     # Load and parse the TOML file
-    toml_file_path = "./photos/HikingSigns/_geovisio.toml"
     toml_data = toml.load(toml_file_path)
-
-    # Search for the filename in the TOML data
+    index = {}
     for section in toml_data.values():
         if isinstance(section, dict):
             pictures = section.get('pictures', {})
             for pic_key, pic_data in pictures.items():
-                if pic_data.get('path') == filename:
-                    pic_id = pic_data.get('id')
-                    hd_href = convert_uuid_to_url(pic_id)
-                    return pic_id, hd_href
+                if pic_data.get('path') and pic_data.get('id'):
+                    index[pic_data['path']] = (pic_data['id'], convert_uuid_to_url(pic_data['id']))
 
-    print(f"Error: File {filename} not found in the TOML data.")
-    return None
+    with atomic_write(index_path, encoding='utf-8') as f:
+        json.dump({"mtime_ns": mtime_ns, "pictures": index}, f)
+    return index
+
+def getPanoramax(filename):
+    """
+    Return the Panoramax id and HD picture URL of a photo, or (None, None) if it was not uploaded.
+    """
+    pic = load_panoramax_index().get(filename)
+    if pic is None:
+        print(f"Error: File {filename} not found in the TOML data.")
+        return None, None
+    return pic
+
+@functools.lru_cache(maxsize=None)
+def load_gps_positions(photo_folder):
+    """
+    Return {photo path: (lat, lon, altitude) or None} for the photos of a folder.
+
+    Read in bulk with exifGps, whose cache is shared with 02-sort-images.py.
+    """
+    paths = [os.path.join(photo_folder, f) for f in os.listdir(photo_folder) if f.endswith(".jpg")]
+    return read_gps_bulk(paths)
 
 def extract_exif_data(image_path):
-    with open(image_path, 'rb') as image_file:
-        image = ExifImage(image_file)
-        if image.has_exif:
-            try:
-                lat = image.gps_latitude
-                lon = image.gps_longitude
-                lat = lat[0] + lat[1] / 60 + lat[2] / 3600
-                lon = lon[0] + lon[1] / 60 + lon[2] / 3600
-                return lat, lon
-            except AttributeError as e:
-                print(f"Error: File {image_path} miss lat/lon in exif data. {e}")
-                return None, None
-        else:
-            print(f"Error: File {image_path} do not have exif data.")
-            return None, None
+    """
+    Return the (lat, lon, altitude) of a photo, or (None, None, None) if it has no GPS position.
+    """
+    gps = load_gps_positions(os.path.dirname(image_path)).get(image_path)
+    if gps is None:
+        print(f"Error: File {image_path} miss lat/lon in exif data.")
+        return None, None, None
+    return gps
+
+class TranscriptionCache:
+    """
+    Persistent cache of the OCR and LLM transcriptions, in a SQLite file.
+
+    One row per crop SHA-1, engine, model and prompt SHA-1, so switching to another model only
+    transcribes what this model never saw. Beyond max_mb of text, the least recently used rows
+    are evicted when the cache is closed. Shared by the worker threads, hence the lock.
+    """
+    def __init__(self, path=transcription_cache_file, max_mb=transcription_cache_max_mb):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS transcriptions (
+                crop_sha1 TEXT NOT NULL,
+                engine TEXT NOT NULL,
+                model TEXT NOT NULL,
+                prompt_sha1 TEXT NOT NULL,
+                text TEXT NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (crop_sha1, engine, model, prompt_sha1)
+            )
+        """)
+        self.max_bytes = max_mb * 1e6
+        self.lock = threading.Lock()
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+
+    def get(self, crop_sha1, engine, model, prompt):
+        """
+        Return the cached text, or None if it must be computed.
+        """
+        key = (crop_sha1, engine, model, hashlib.sha1(prompt.encode()).hexdigest())
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT text FROM transcriptions WHERE crop_sha1 = ? AND engine = ? AND model = ? AND prompt_sha1 = ?", key
+            ).fetchone()
+            if row is None:
+                self.misses[engine] += 1
+                return None
+            self.hits[engine] += 1
+            self.connection.execute(
+                "UPDATE transcriptions SET last_used = ? WHERE crop_sha1 = ? AND engine = ? AND model = ? AND prompt_sha1 = ?", (time.time(), *key)
+            )
+            return row[0]
+
+    def put(self, crop_sha1, engine, model, prompt, text):
+        key = (crop_sha1, engine, model, hashlib.sha1(prompt.encode()).hexdigest())
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO transcriptions VALUES (?, ?, ?, ?, ?, ?)", (*key, text, time.time()))
+            self.connection.commit()
+
+    def evict(self):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT rowid, LENGTH(CAST(text AS BLOB)) FROM transcriptions ORDER BY last_used"
+            ).fetchall()
+            excess = sum(size for _, size in rows) - self.max_bytes
+            evicted = []
+            for rowid, size in rows:
+                if excess <= 0:
+                    break
+                evicted.append((rowid,))
+                excess -= size
+            self.connection.executemany("DELETE FROM transcriptions WHERE rowid = ?", evicted)
+            self.connection.commit()
+        if evicted:
+            print(f"Transcription cache: {len(evicted)} least recently used entries evicted")
+
+    def report(self):
+        for engine in sorted(set(self.hits) | set(self.misses)):
+            total = self.hits[engine] + self.misses[engine]
+            print(f"Transcription cache {engine}: {self.hits[engine]} hits, {self.misses[engine]} misses, {100 * self.hits[engine] / total:.0f}% hit rate")
+
+    def close(self):
+        self.evict()
+        self.report()
+        self.connection.close()
+
+@functools.lru_cache(maxsize=None)
+def get_transcription_cache():
+    return TranscriptionCache()
+
+def ocr_model(batched):
+    """
+    Model of the OCR texts in the transcription cache.
+
+    Besides the languages, it has the mode and the height of the batched crops, which both change
+    the recognized text.
+    """
+    model = "easyocr:" + "+".join(ocr_languages)
+    return f"{model}:batched:{ocr_height}" if batched else f"{model}:readtext"
 
 def get_ocr_text(reader, image_path):
-    return " \n".join(reader.readtext(image_path, detail=0))
+    cache = get_transcription_cache()
+    key = (file_sha1(image_path), "ocr", ocr_model(batched=False), "")
+    text = cache.get(*key)
+    if text is None:
+        text = " \n".join(reader.readtext(image_path, detail=0))
+        cache.put(*key, text)
+    return text
 
 def get_llm_text(image_path, prompt):
-    res = ollama.chat(
-        model=llm_model,
-        messages= [{
-            "role": "user",
-            "content": prompt,
-            "images": [image_path]
-        }],
-    )
+    cache = get_transcription_cache()
+    key = (file_sha1(image_path), "llm", llm_model, prompt)
+    text = cache.get(*key)
+    if text is None:
+        res = ollama.chat(
+            model=llm_model,
+            messages= [{
+                "role": "user",
+                "content": prompt,
+                "images": [image_path]
+            }],
+        )
+        text = res["message"]["content"]
+        cache.put(*key, text)
+    return text
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+class LlmTranscriber:
+    """
+    Transcribe crops with the Ollama chat API, keeping up to llm_concurrency requests in flight.
+
+    A single AsyncClient, hence a single pool of HTTP connections, serves every request. Requests
+    that time out, fail to connect or get a 429 or 5xx answer are retried with exponential
+    backoff; a crop that still fails gets an empty text. The latency of each answered request is
+    recorded for the report.
+    """
+    def __init__(self, host=llm_host, concurrency=llm_concurrency, timeout=llm_timeout, retries=llm_retries):
+        self.client = ollama.AsyncClient(host=host, timeout=timeout)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.retries = retries
+        self.latencies = []
+        self.retried = 0
+        self.failed = 0
+
+    async def transcribe(self, image_path, prompt):
+        cache = get_transcription_cache()
+        key = (await asyncio.to_thread(file_sha1, image_path), "llm", llm_model, prompt)
+        text = cache.get(*key)
+        if text is not None:
+            return text
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.semaphore:
+                    # Read the crop in the bounded section, at most llm_concurrency crops are in memory
+                    image = await asyncio.to_thread(read_bytes, image_path)
+                    start = time.perf_counter()
+                    res = await self.client.chat(
+                        model=llm_model,
+                        messages=[{"role": "user", "content": prompt, "images": [image]}],
+                    )
+                    self.latencies.append(time.perf_counter() - start)
+                cache.put(*key, res["message"]["content"])
+                return res["message"]["content"]
+            # ollama turns the httpx connection errors into the builtin ConnectionError
+            except (httpx.TransportError, ConnectionError, ollama.ResponseError) as e:
+                retryable = not isinstance(e, ollama.ResponseError) or e.status_code == 429 or e.status_code >= 500
+                if not retryable or attempt == self.retries:
+                    self.failed += 1
+                    print(f"Error: LLM failed on {image_path} => {e}")
+                    return ""
+                self.retried += 1
+            # Back off outside of the semaphore, the other requests keep the slot busy, without holding the crop
+            image = None
+            await asyncio.sleep(2 ** attempt)
+
+    def report(self, wall_seconds):
+        latencies = sorted(self.latencies)
+        if latencies:
+            p50, p95 = latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.95)]
+            print(f"LLM: {len(latencies)} requests, {len(latencies) / max(wall_seconds, 1e-9):.2f} req/s, "
+                  f"latency p50 {p50:.2f} s, p95 {p95:.2f} s, {self.retried} retries, {self.failed} failed")
+
+# Reader of an OCR worker process, one per process
+ocr_reader = None
+
+def init_ocr_worker(devices):
+    global ocr_reader
+    ocr_reader = easyocr.Reader(ocr_languages, gpu=devices.get())
 
-    return res["message"]["content"]
+def ocr_batch(crop_paths, width, height):
+    results = ocr_reader.readtext_batched(crop_paths, n_width=width, n_height=height, detail=0, batch_size=len(crop_paths))
+    return [" \n".join(texts) for texts in results]
+
+# Function to list the devices of the OCR worker processes: one per GPU, or ocr_cpu_workers CPU ones
+def ocr_devices():
+    import torch  # Installed with easyocr
+    if torch.cuda.is_available():
+        return [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+    return [False] * ocr_cpu_workers
+
+def ocr_batches(crop_paths, batch_size):
+    """
+    Yield (crop paths, width, height) batches of crops with similar aspect ratios.
+
+    readtext_batched resizes every image of a batch to the same size, so grouping the crops by
+    aspect ratio keeps their text from being squashed.
+    """
+    ratios = {}
+    for crop_path in crop_paths:
+        with Image.open(crop_path) as image:
+            ratios[crop_path] = image.width / image.height
+    crop_paths = sorted(crop_paths, key=ratios.get)
+    for start in range(0, len(crop_paths), batch_size):
+        batch = crop_paths[start:start + batch_size]
+        ratio = ratios[batch[len(batch) // 2]]
+        yield batch, max(round(ocr_height * ratio), 1), ocr_height
+
+def run_ocr_stage(crop_paths):
+    """
+    Return {crop path: OCR text} for the crops, from the transcription cache or batched OCR.
+
+    The crops missing from the cache are recognized in batches by worker processes, each with
+    its own easyocr.Reader, instead of threads contending for a shared one.
+    """
+    cache = get_transcription_cache()
+    model = ocr_model(batched=True)
+    texts, keys = {}, {}
+    for crop_path in crop_paths:
+        keys[crop_path] = (file_sha1(crop_path), "ocr", model, "")
+        text = cache.get(*keys[crop_path])
+        if text is not None:
+            texts[crop_path] = text
+    missing = [crop_path for crop_path in crop_paths if crop_path not in texts]
+
+    start = time.perf_counter()
+    if missing:
+        devices = ocr_devices()
+        context = multiprocessing.get_context("spawn")
+        device_queue = context.Queue()
+        for device in devices:
+            device_queue.put(device)
+        with ProcessPoolExecutor(max_workers=len(devices), mp_context=context, initializer=init_ocr_worker, initargs=(device_queue,)) as executor:
+            futures = {executor.submit(ocr_batch, *batch): batch[0] for batch in ocr_batches(missing, ocr_batch_size)}
+            with tqdm(total=len(missing), desc="OCR") as progress:
+                for future in as_completed(futures):
+                    for crop_path, text in zip(futures[future], future.result()):
+                        texts[crop_path] = text
+                        cache.put(*keys[crop_path], text)
+                    progress.update(len(futures[future]))
+    seconds = time.perf_counter() - start
+    print(f"OCR: {len(crop_paths)} crops, {len(crop_paths) - len(missing)} cached, {len(missing)} recognized in {seconds:.1f} s, "
+          f"{len(missing) / max(seconds, 1e-9):.1f} crops/s")
+    return texts
+
+def load_detections(photo_folder, model):
+    """
+    Return {image name: rows} of the store for this model, without the photos replaced since script 22 ran.
+    """
+    detections = read_detections(columns=["class_id", "score"], model=model)
+    stored_sha1s = read_image_sha1s(model=model)
+    paths = [os.path.join(photo_folder, filename) for filename in detections]
+    paths = [path for path in paths if os.path.exists(path)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        sha1s = dict(zip(paths, executor.map(file_sha1, paths)))
+    return {filename: rows for filename, rows in detections.items() if sha1s.get(os.path.join(photo_folder, filename)) == stored_sha1s[filename]}
+
+def get_detection_properties(rows):
+    """
+    Best score of the top and destination parts in the detections stored by script 22.
+    """
+    properties = {}
+    for cls, key in ((TOP_CLASS, "top"), (DESTINATION_CLASS, "destination")):
+        scores = [row["score"] for row in rows if row["class_id"] == cls]
+        properties[f"detection:{key}:count"] = len(scores)
+        if scores:
+            properties[f"detection:{key}:score"] = round(max(scores), 3)
+    return properties
 
 def create_geojson_feature(lat, lon, filename, properties):
     feature = {
@@ -90,69 +408,111 @@ def create_geojson_feature(lat, lon, filename, properties):
     }
     return feature
 
-def process_image(reader, filename, photo_folder, crop_top_folder, crop_destination_folder):
+class GeoJsonWriter:
+    """
+    Write the features as they complete, in the order of the photo filenames.
+
+    Each feature is appended as one line to a newline-delimited GeoJSON (GeoJSONSeq) file and
+    flushed, so a crash loses at most the feature being written. Every finalize_every features,
+    and at close, the FeatureCollection file is written to a temporary file and renamed over the
+    previous one, so it is always complete. Features completing out of order are held back until
+    those of the previous photos are written, so both files have a deterministic order.
+    """
+    def __init__(self, output_file, filenames, finalize_every=100):
+        self.output_file = output_file
+        self.seq_file = os.path.splitext(output_file)[0] + ".geojsonseq"
+        self.positions = {filename: i for i, filename in enumerate(filenames)}
+        self.finalize_every = finalize_every
+        self.features = []  # Written so far, in filename order
+        self.waiting = {}  # Completed out of order, by position
+        self.next_position = 0
+        self.seq = open(self.seq_file, 'w', encoding='utf-8')
+
+    def add(self, filename, feature):
+        """
+        Record the feature of a photo, None if the photo has no feature.
+        """
+        self.waiting[self.positions[filename]] = feature
+        while self.next_position in self.waiting:
+            feature = self.waiting.pop(self.next_position)
+            self.next_position += 1
+            if feature:
+                self.seq.write(json.dumps(feature, ensure_ascii=False) + "\n")
+                self.seq.flush()
+                self.features.append(feature)
+                if len(self.features) % self.finalize_every == 0:
+                    self.finalize()
+
+    def finalize(self):
+        with atomic_write(self.output_file, encoding='utf-8') as f:
+            json.dump(geojson.FeatureCollection(self.features), f, indent=2, ensure_ascii=False)
+
+    def close(self):
+        self.seq.close()
+        self.finalize()
+
+@functools.lru_cache(maxsize=None)
+def index_crops(crop_folder, part):
+    """
+    Return {base filename: [crop paths]} for the {base}_{part}_{instance}.jpg crops of a folder.
+
+    A single os.scandir pass per folder and run, instead of probing {base}_{part}_1.jpg, _2.jpg...
+    for each photo. Script 22 numbers the crops by instance and skips the instances it does not
+    crop, so the numbers can have gaps; the crops are sorted by number.
+    """
+    if not os.path.isdir(crop_folder):
+        return {}
+    crops = defaultdict(list)
+    with os.scandir(crop_folder) as entries:
+        for entry in entries:
+            name, extension = os.path.splitext(entry.name)
+            base_filename, _, number = name.rpartition(f"_{part}_")
+            if extension == ".jpg" and base_filename and number.isdigit() and entry.is_file():
+                crops[base_filename].append((int(number), entry.path))
+    return {base_filename: [path for _, path in sorted(paths)] for base_filename, paths in crops.items()}
+
+# Function to list the crops of a photo written by script 22, in instance order
+def list_crops(crop_folder, base_filename, part):
+    return index_crops(crop_folder, part).get(base_filename, [])
+
+# Function to add the non-empty texts of a part as numbered properties, e.g. name:llm:1, and all of them joined
+def add_text_properties(properties, prefix, engine, texts):
+    texts = [text for text in texts if text.strip()]
+    for index, text in enumerate(texts, 1):
+        properties[f"{prefix}:{engine}:{index}"] = text
+    if len(texts) > 0:
+        properties[f"{prefix}:{engine}:all"] = " ;\n".join(texts)
+
+def process_image(reader, filename, photo_folder, crop_top_folder, crop_destination_folder, detections=None, llm_texts=None, ocr_texts=None):
+    """
+    Build the GeoJSON feature of a photo, or None if it has no GPS position.
+
+    llm_texts and ocr_texts map crop paths to their transcription, when already done by
+    LlmTranscriber or run_ocr_stage.
+    """
     image_path = os.path.join(photo_folder, filename)
-    lat, lon = extract_exif_data(image_path)
-    if lat and lon:
+    lat, lon, altitude = extract_exif_data(image_path)
+    if lat is not None and lon is not None:
         properties = {
             "tourism": "information",
             "information": "guidepost",
             "hiking": "yes"
         }
+        if altitude is not None:
+            properties["gps:altitude"] = round(altitude, 1)
+        if detections and filename in detections:
+            properties.update(get_detection_properties(detections[filename]))
         base_filename = os.path.splitext(filename)[0]
 
-        ocr_names, llm_names = [], []
-        index, index_ocr, index_llm = 1, 1, 1
-        while True:
-            top_image_path = os.path.join(crop_top_folder, f"{base_filename}_top_{index}.jpg")
-            if not os.path.exists(top_image_path):
-                break
+        parts = (("name", crop_top_folder, "top", llm_prompt_top), ("dest", crop_destination_folder, "destination", llm_prompt_dest))
+        for prefix, crop_folder, part, prompt in parts:
+            crops = list_crops(crop_folder, base_filename, part)
             if enable_ocr:
-                easy_text = get_ocr_text(reader, top_image_path)
-                if easy_text.strip():
-                    properties["name:ocr:{index_ocr}"] = easy_text
-                    ocr_names.append(easy_text)
-                    index_ocr += 1
+                texts = [ocr_texts.get(crop, "") if ocr_texts is not None else get_ocr_text(reader, crop) for crop in crops]
+                add_text_properties(properties, prefix, "ocr", texts)
             if enable_llm:
-                llm_text = get_llm_text(top_image_path, llm_prompt_top)
-                if llm_text.strip():
-                    properties[f"name:llm:{index_llm}"] = llm_text
-                    llm_names.append(llm_text)
-                    index_llm += 1
-            index += 1
-            
-
-        if len(ocr_names) > 0:
-            properties["name:ocr:all"] = " ;\n".join(ocr_names)
-
-        if len(llm_names) > 0:
-            properties["name:llm:all"] = " ;\n".join(llm_names)
-
-        ocr_dests, llm_dests = [], []
-        index, index_ocr, index_llm = 1, 1, 1
-        while True:
-            dest_image_path = os.path.join(crop_destination_folder, f"{base_filename}_destination_{index}.jpg")
-            if not os.path.exists(dest_image_path):
-                break
-            if enable_ocr:
-                easy_text = get_ocr_text(reader, dest_image_path)
-                if easy_text.strip():
-                    properties[f"dest:ocr:{index_ocr}"] = easy_text
-                    ocr_dests.append(easy_text)
-                    index_ocr += 1
-            if enable_llm:
-                llm_text = get_llm_text(dest_image_path, llm_prompt_dest)
-                if llm_text.strip():
-                    properties[f"dest:llm:{index_llm}"] = llm_text
-                    llm_dests.append(llm_text)
-                    index_llm += 1
-            index += 1
-
-        if len(ocr_dests) > 0:
-            properties["dest:ocr:all"] = " ;\n".join(ocr_dests)
-
-        if len(llm_dests) > 0:
-            properties["dest:llm:all"] = " ;\n".join(llm_dests)
+                texts = [llm_texts.get(crop, "") if llm_texts is not None else get_llm_text(crop, prompt) for crop in crops]
+                add_text_properties(properties, prefix, "llm", texts)
 
         id, hd_href = getPanoramax(filename)
         if id:
@@ -161,37 +521,82 @@ def process_image(reader, filename, photo_folder, crop_top_folder, crop_destinat
 
         return create_geojson_feature(lat, lon, filename, properties)
 
+async def process_images_llm(filenames, writer, photo_folder, crop_top_folder, crop_destination_folder, detections):
+    """
+    Transcribe the crops of all the photos concurrently and write their features as they complete.
+    """
+    transcriber = LlmTranscriber()
+
+    async def process(filename):
+        lat, lon, _ = extract_exif_data(os.path.join(photo_folder, filename))
+        if lat is None or lon is None:
+            return filename, None  # No feature, no need to transcribe its crops
+        base_filename = os.path.splitext(filename)[0]
+        crops = [(crop, llm_prompt_top) for crop in list_crops(crop_top_folder, base_filename, "top")]
+        crops += [(crop, llm_prompt_dest) for crop in list_crops(crop_destination_folder, base_filename, "destination")]
+        texts = await asyncio.gather(*(transcriber.transcribe(crop, prompt) for crop, prompt in crops))
+        llm_texts = dict(zip((crop for crop, _ in crops), texts))
+        feature = await asyncio.to_thread(process_image, None, filename, photo_folder, crop_top_folder, crop_destination_folder, detections, llm_texts)
+        return filename, feature
+
+    start = time.perf_counter()
+    tasks = [asyncio.create_task(process(filename)) for filename in filenames]
+    for task in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="Processing images"):
+        writer.add(*await task)
+    transcriber.report(time.perf_counter() - start)
+
 def main():
     photo_folder = "./photos/HikingSigns"
     crop_top_folder = "./crop/top"
     crop_destination_folder = "./crop/destination"
     output_file = "hikingSigns.geojson"
-    geojson_features = []
 
     if os.path.exists(output_file):
         os.remove(output_file)
 
-    filenames = [f for f in os.listdir(photo_folder) if f.endswith(".jpg")]
-
-    reader = None
-    if enable_ocr:
-        reader = easyocr.Reader(['fr'], gpu=True)  # Initialize EasyOCR reader once
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            futures = {executor.submit(process_image, reader, filename, photo_folder, crop_top_folder, crop_destination_folder): filename for filename in filenames}
-            for future in tqdm(as_completed(futures), total=len(futures), desc="Processing images"):
-                feature = future.result()
-                if feature:
-                    geojson_features.append(feature)
-                    with open(output_file, 'w', encoding='utf-8') as f:
-                        json.dump(geojson.FeatureCollection(geojson_features), f, indent=2, ensure_ascii=False)
-
-    elif enable_llm:
-        for filename in tqdm(filenames, total=len(filenames), desc="Processing images"):
-            feature = process_image(reader, filename, photo_folder, crop_top_folder, crop_destination_folder)
-            if feature:
-                geojson_features.append(feature)
-                with open(output_file, 'w', encoding='utf-8') as f:
-                    json.dump(geojson.FeatureCollection(geojson_features), f, indent=2, ensure_ascii=False)
+    filenames = sorted(f for f in os.listdir(photo_folder) if f.endswith(".jpg"))
+    writer = GeoJsonWriter(output_file, filenames)
+    # Build the Panoramax, GPS and crop indexes and open the transcription cache before the worker threads share them
+    load_panoramax_index()
+    load_gps_positions(photo_folder)
+    index_crops(crop_top_folder, "top")
+    index_crops(crop_destination_folder, "destination")
+    cache = get_transcription_cache()
+    # Scores of the detector, without running it again
+    detections = {}
+    if od_model or os.path.exists(od_weights):
+        detections = load_detections(photo_folder, od_model or file_sha1(od_weights))
+
+    # Closing finalizes the FeatureCollection with the features done, even after an error
+    try:
+        reader, ocr_texts = None, None
+        if enable_ocr:
+            # Like the LLM path, the crops of the photos without a GPS position, hence without a feature, are not read
+            positions = load_gps_positions(photo_folder)
+            crops = []
+            for filename in filenames:
+                if positions.get(os.path.join(photo_folder, filename)) is None:
+                    continue
+                base_filename = os.path.splitext(filename)[0]
+                crops += list_crops(crop_top_folder, base_filename, "top") + list_crops(crop_destination_folder, base_filename, "destination")
+            if ocr_batched:
+                ocr_texts = run_ocr_stage(crops)
+            else:
+                reader = easyocr.Reader(ocr_languages, gpu=True)  # Initialize EasyOCR reader once
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                futures = {executor.submit(process_image, reader, filename, photo_folder, crop_top_folder, crop_destination_folder, detections, None, ocr_texts): filename for filename in filenames}
+                for future in tqdm(as_completed(futures), total=len(futures), desc="Processing images"):
+                    writer.add(futures[future], future.result())
+            if not ocr_batched:
+                seconds = time.perf_counter() - start
+                print(f"OCR threads: {len(crops)} crops in {seconds:.1f} s, {len(crops) / max(seconds, 1e-9):.1f} crops/s")
+
+        elif enable_llm:
+            asyncio.run(process_images_llm(filenames, writer, photo_folder, crop_top_folder, crop_destination_folder, detections))
+    finally:
+        writer.close()
+        cache.close()
 
 if __name__ == "__main__":
     main()
@@ -1,54 +1,31 @@
 import os
 import cv2
-import torch
-from detectron2.config import get_cfg
+import argparse
 from detectron2.data import MetadataCatalog
-from detectron2.data.datasets import register_coco_instances
-from detectron2.engine import DefaultPredictor
 from detectron2.utils.visualizer import Visualizer, ColorMode
+from modelFactory import build_cfg, get_predictor, model_hash, register_datasets
+from detectionsStore import file_sha1, read_detections, read_image_sha1s, rows_from_instances, to_instances, write_detections
 
-classes = ["top", "destination", "poster", "bike_sign", "street_sign", "panel"]
+parser = argparse.ArgumentParser(description="Visualize the predictions of the segmentation model.")
+parser.add_argument("--from-store", action="store_true", help="Draw the stored detections of this model, run it only for the other photos")
+args = parser.parse_args()
 
-# Définir les chemins
-train_set = "./coco-train-hiking-sign"
-train_annotations = os.path.join(train_set, "result.json")
-
-test_set = "./coco-test-hiking-sign"
-test_annotations = os.path.join(test_set, "result.json")
-
-# Register the dataset
-def register_hiking_signs_dataset():
-    register_coco_instances("hiking_signs_train", {}, train_annotations, train_set)
-    register_coco_instances("hiking_signs_test", {}, test_annotations, test_set)
-
-register_hiking_signs_dataset()
+register_datasets("is")
 
 # Configuration
-cfg = get_cfg()
-cfg.OUTPUT_DIR = "./model-is"
-
-cfg.merge_from_file("./detectron2/configs/COCO-Detection/faster_rcnn_R_50_FPN_3x.yaml")
-#cfg.MODEL.WEIGHTS = "detectron2://COCO-Detection/faster_rcnn_R_50_FPN_3x/137849458/model_final_280758.pkl"
-cfg.MODEL.WEIGHTS = os.path.join(cfg.OUTPUT_DIR, "model_final.pth")
-
-cfg.MODEL.ROI_HEADS.BATCH_SIZE_PER_IMAGE = 128
-cfg.MODEL.ROI_HEADS.NUM_CLASSES = len(classes)
-cfg.MODEL.DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
-cfg.MODEL.MASK_ON = True
+cfg = build_cfg("is")
 
-cfg.DATASETS.TRAIN = ("hiking_signs_train",)
-cfg.DATASETS.TEST = ("hiking_signs_test",)
+# Detections of the current weights in the store, by image name
+stored = {}
+if args.from_store:
+    model_key = model_hash("is")
+    stored = read_detections(model=model_key)
+    stored_sha1s = read_image_sha1s(model=model_key)
+    print(f"{len(stored)} photos in the detections store")
+new_rows = {}  # Rows of the photos run through the model, added to the store at the end
 
-cfg.SOLVER.IMS_PER_BATCH = 2
-cfg.SOLVER.BASE_LR = 0.02
-cfg.SOLVER.STEPS = (420, 500)
-cfg.SOLVER.MAX_ITER = 540
-
-cfg.DATALOADER.NUM_WORKERS = 4
-
-
-# Create the predictor
-predictor = DefaultPredictor(cfg)
+# Create the predictor, only when some photo is not in the store
+predictor = None if args.from_store else get_predictor("is")
 
 # Create output folder for visualizations
 output_vis_folder = "./viz-is"
@@ -57,8 +34,16 @@ os.makedirs(output_vis_folder, exist_ok=True)
 # Visualization function
 def visualize_predictions(image_path, predictor, output_folder):
     image = cv2.imread(image_path)
-    outputs = predictor(image)
-    instances = outputs["instances"].to("cpu")
+    filename = os.path.basename(image_path)
+    sha1 = file_sha1(image_path) if args.from_store else None
+    # The stored rows are used only if the photo was not replaced since
+    if filename in stored and stored_sha1s[filename] == sha1:
+        instances = to_instances(stored[filename], image.shape[:2])
+    else:
+        outputs = (predictor or get_predictor("is"))(image)
+        instances = outputs["instances"].to("cpu")
+        if args.from_store:
+            new_rows[filename] = rows_from_instances(filename, sha1, model_key, instances)
     instances = instances[instances.scores > 0.5]  # Filter instances by score
 
     v = Visualizer(image[:, :, ::-1],
@@ -86,4 +71,7 @@ evaluate_with_visualization("coco-train-hiking-sign/images", predictor, output_v
 #val_loader = build_detection_test_loader(cfg, "hiking_signs_train")
 #inference_on_dataset(predictor.model, val_loader, evaluator)
 
+if new_rows:
+    write_detections(new_rows)
+
 print("Model evaluation and visualization completed.")
@@ -0,0 +1,142 @@
+import os
+import hashlib
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from pycocotools import mask as mask_util
+from exifGps import atomic_write
+
+# Written by 22-cropUsingObjectDetectionModel.py, read by scripts 21, 30 and 91
+DETECTIONS_FILE = "crop/detections.parquet"
+
+# Class ids of the guidepost parts, as predicted by the model-od model
+TOP_CLASS = 5
+DESTINATION_CLASS = 1
+
+# One row per instance and model; boxes in pixels of the original photo, masks as COCO RLE counts.
+# A photo without any instance gets a single row with instance -1, so it is known as processed.
+SCHEMA = pa.schema([
+    ("image", pa.string()),
+    ("image_sha1", pa.string()),
+    ("model", pa.string()),
+    ("height", pa.int32()),
+    ("width", pa.int32()),
+    ("instance", pa.int32()),
+    ("class_id", pa.int16()),
+    ("score", pa.float32()),
+    ("x0", pa.float32()),
+    ("y0", pa.float32()),
+    ("x1", pa.float32()),
+    ("y1", pa.float32()),
+    ("mask_rle", pa.string()),
+])
+
+# Function to hash a file without loading it in memory at once, e.g. the model weights
+def file_sha1(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def encode_mask(mask):
+    rle = mask_util.encode(np.asfortranarray(mask.astype(np.uint8)))
+    return rle["counts"].decode("ascii")
+
+def decode_mask(mask_rle, height, width):
+    return mask_util.decode({"size": [height, width], "counts": mask_rle.encode("ascii")}).astype(bool)
+
+def rows_from_instances(image_name, image_sha1, model_hash, instances):
+    """
+    Convert the detectron2 Instances of one photo to store rows.
+    """
+    height, width = instances.image_size
+    masks = instances.pred_masks.numpy() if instances.has("pred_masks") else None
+    rows = []
+    if len(instances) == 0:
+        return [{"image": image_name, "image_sha1": image_sha1, "model": model_hash, "height": height, "width": width, "instance": -1}]
+    for i, (bbox, cls, score) in enumerate(zip(instances.pred_boxes.tensor.tolist(), instances.pred_classes.tolist(), instances.scores.tolist())):
+        rows.append({
+            "image": image_name,
+            "image_sha1": image_sha1,
+            "model": model_hash,
+            "height": height,
+            "width": width,
+            "instance": i,
+            "class_id": cls,
+            "score": score,
+            "x0": bbox[0],
+            "y0": bbox[1],
+            "x1": bbox[2],
+            "y1": bbox[3],
+            "mask_rle": encode_mask(masks[i]) if masks is not None else None,
+        })
+    return rows
+
+def read_detections(path=DETECTIONS_FILE, columns=None, model=None):
+    """
+    Return {image name: [row, ...]} for every processed photo, or {} if there is no store.
+
+    The rows are sorted by instance; a photo without any instance maps to an empty list.
+    If model is given, only the rows predicted by this model key (see modelFactory.model_hash) are read.
+    """
+    if not os.path.exists(path):
+        return {}
+    if columns is not None:
+        columns = sorted(set(columns) | {"image", "instance"})
+    detections = {}
+    filters = [("model", "==", model)] if model else None
+    for row in pq.read_table(path, columns=columns, filters=filters).to_pylist():
+        rows = detections.setdefault(row["image"], [])
+        if row["instance"] >= 0:
+            rows.append(row)
+    for rows in detections.values():
+        rows.sort(key=lambda row: row["instance"])
+    return detections
+
+def read_image_sha1s(path=DETECTIONS_FILE, model=None):
+    """
+    Return {image name: SHA-1 of the photo when its rows were written}, or {} if there is no store.
+
+    Rows whose SHA-1 differs from the current file are those of a replaced photo.
+    """
+    if not os.path.exists(path):
+        return {}
+    filters = [("model", "==", model)] if model else None
+    table = pq.read_table(path, columns=["image", "image_sha1"], filters=filters)
+    return dict(zip(table["image"].to_pylist(), table["image_sha1"].to_pylist()))
+
+def write_detections(rows_by_image, path=DETECTIONS_FILE):
+    """
+    Replace the rows of the given images and model in the store, keeping all the other rows.
+    """
+    table = pa.Table.from_pylist([row for rows in rows_by_image.values() for row in rows], schema=SCHEMA)
+    if os.path.exists(path):
+        previous = pq.read_table(path).cast(SCHEMA)
+        replaced = pc.binary_join_element_wise(table["image"], table["model"], "\n").unique()
+        keys = pc.binary_join_element_wise(previous["image"], previous["model"], "\n")
+        table = pa.concat_tables([previous.filter(pc.invert(pc.is_in(keys, value_set=replaced))), table])
+    table = table.sort_by([("image", "ascending"), ("model", "ascending"), ("instance", "ascending")])
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with atomic_write(path, 'wb') as f:
+        pq.write_table(table, f, compression="zstd")
+
+def to_instances(rows, image_size):
+    """
+    Build detectron2 Instances from the rows of one photo, e.g. for the Visualizer.
+
+    image_size is the (height, width) of the photo, needed when it has no rows.
+    """
+    # detectron2 is only needed by the scripts that draw the detections
+    import torch
+    from detectron2.structures import Boxes, Instances
+
+    height, width = image_size
+    instances = Instances((height, width))
+    instances.pred_boxes = Boxes(torch.tensor([[row["x0"], row["y0"], row["x1"], row["y1"]] for row in rows], dtype=torch.float32).reshape(-1, 4))
+    instances.scores = torch.tensor([row["score"] for row in rows], dtype=torch.float32)
+    instances.pred_classes = torch.tensor([row["class_id"] for row in rows], dtype=torch.int64)
+    if rows and all(row["mask_rle"] is not None for row in rows):
+        instances.pred_masks = torch.from_numpy(np.stack([decode_mask(row["mask_rle"], height, width) for row in rows]))
+    return instances
@@ -0,0 +1,42 @@
+import json
+import os
+import torch
+
+# Written by 10-testGpu.py
+REPORT_FILE = "device_report.json"
+
+def load_device_report(report_file=REPORT_FILE):
+    """
+    Return the fastest configuration measured by 10-testGpu.py, or None if there is no report.
+
+    The configuration is a dict with the keys "device", "threads" and "mkldnn".
+    """
+    if not os.path.exists(report_file):
+        return None
+    with open(report_file, 'r') as f:
+        return json.load(f).get("best")
+
+# Function to check that a tensor can actually be created on a device, not only that its backend is built
+def is_usable(device):
+    try:
+        torch.zeros(1, device=device)
+        return True
+    except Exception:
+        return False
+
+def configure_device(cfg, report_file=REPORT_FILE):
+    """
+    Set cfg.MODEL.DEVICE and the torch CPU settings from the device report.
+
+    Without a report, or if the reported device is not usable anymore, fall back to CUDA when
+    available and CPU otherwise.
+    """
+    best = load_device_report(report_file)
+    if best is None or not is_usable(best["device"]):
+        cfg.MODEL.DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+        return cfg
+    cfg.MODEL.DEVICE = best["device"]
+    if best["device"] == "cpu":
+        torch.set_num_threads(best["threads"])
+        torch.backends.mkldnn.enabled = best["mkldnn"]
+    return cfg
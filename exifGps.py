@@ -0,0 +1,213 @@
+import os
+import json
+import glob
+import time
+import struct
+import argparse
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Positions already read, shared by 02-sort-images.py and 30-photosToGeoJson.py
+GPS_CACHE_FILE = "gps_cache.json"
+GPS_WORKERS = 8  # Threads reading the photos, mostly waiting on the disk
+
+GPS_INFO_TAG = 0x8825  # Offset of the GPS IFD, in IFD0
+GPS_TAGS = {1: "lat_ref", 2: "lat", 3: "lon_ref", 4: "lon", 5: "altitude_ref", 6: "altitude"}
+# struct format and size of the EXIF value types used by the GPS tags
+TYPES = {1: ("B", 1), 2: ("c", 1), 3: ("H", 2), 4: ("I", 4), 5: ("II", 8), 7: ("B", 1), 9: ("i", 4), 10: ("ii", 8)}
+
+cache_lock = threading.Lock()
+
+@contextlib.contextmanager
+def atomic_write(path, mode='w', **kwargs):
+    """
+    Open a temporary file next to path, renamed to path once written.
+
+    Readers never see a partial file, and an interrupted write leaves the previous one. The
+    temporary name is unique to the process and thread, so concurrent writers do not collide.
+    """
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, mode, **kwargs) as f:
+            yield f
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def find_tiff_header(f):
+    """
+    Walk the JPEG segments up to the EXIF APP1 one and return the file offset of its TIFF header.
+
+    Only the 4-byte header of the segments before it is read; returns None if there is no EXIF.
+    """
+    if f.read(2) != b"\xff\xd8":
+        return None
+    while True:
+        marker, length = struct.unpack(">2sH", f.read(4))
+        if marker[0] != 0xFF or marker[1] in (0xD9, 0xDA):
+            return None  # Not a segment, end of image or start of the compressed data
+        if marker[1] == 0xE1:
+            start = f.tell()
+            if f.read(6) == b"Exif\x00\x00":
+                return f.tell()
+            f.seek(start)  # Another APP1 segment, e.g. XMP
+        f.seek(length - 2, 1)
+
+def read_ifd(f, tiff, offset, order, tags):
+    """
+    Return {tag: (type, count, value field)} for the given tags of the IFD at offset.
+    """
+    f.seek(tiff + offset)
+    count, = struct.unpack(order + "H", f.read(2))
+    entries = f.read(12 * count)
+    found = {}
+    for i in range(count):
+        tag, kind, values, field = struct.unpack(order + "HHI4s", entries[12 * i:12 * i + 12])
+        if tag in tags:
+            found[tag] = (kind, values, field)
+    return found
+
+def read_value(f, tiff, order, kind, count, field):
+    """
+    Return the values of an IFD entry, read from the entry itself when they fit in 4 bytes.
+    """
+    if kind not in TYPES:
+        return None
+    fmt, size = TYPES[kind]
+    data = field
+    if size * count > 4:
+        f.seek(tiff + struct.unpack(order + "I", field)[0])
+        data = f.read(size * count)
+    values = struct.unpack(order + fmt * count, data[:size * count])
+    if kind == 2:
+        return b"".join(values).rstrip(b"\x00").decode("ascii", "replace")
+    if kind in (5, 10):
+        # Rationals, as numerator / denominator pairs
+        return [n / d if d else None for n, d in zip(values[::2], values[1::2])]
+    return list(values)
+
+def to_degrees(dms, ref, negative_ref):
+    if not dms or len(dms) != 3 or None in dms:
+        return None
+    degrees = dms[0] + dms[1] / 60 + dms[2] / 3600
+    return -degrees if ref and ref.upper().startswith(negative_ref) else degrees
+
+def read_gps(path):
+    """
+    Return the (latitude, longitude, altitude) of a JPEG from its EXIF GPS IFD, or None.
+
+    Only the segment headers, the IFD0 entries, the GPS IFD entries and the GPS values are
+    read; neither the other EXIF tags nor the embedded thumbnail are. Southern latitudes and
+    western longitudes are negative, so is an altitude below sea level. The altitude is None if
+    the photo has none.
+    """
+    try:
+        with open(path, "rb") as f:
+            tiff = find_tiff_header(f)
+            if tiff is None:
+                return None
+            order = {b"II": "<", b"MM": ">"}.get(f.read(2))
+            if order is None:
+                return None
+            magic, ifd0 = struct.unpack(order + "HI", f.read(6))
+            if magic != 42:
+                return None
+            gps_info = read_ifd(f, tiff, ifd0, order, {GPS_INFO_TAG})
+            if GPS_INFO_TAG not in gps_info:
+                return None
+            kind, count, field = gps_info[GPS_INFO_TAG]
+            gps_ifd = struct.unpack(order + "I", field)[0] if kind == 4 else struct.unpack(order + "H", field[:2])[0]
+            gps = {GPS_TAGS[tag]: read_value(f, tiff, order, *entry) for tag, entry in read_ifd(f, tiff, gps_ifd, order, GPS_TAGS).items()}
+    except (OSError, struct.error):
+        return None  # Unreadable or truncated file
+
+    lat = to_degrees(gps.get("lat"), gps.get("lat_ref"), "S")
+    lon = to_degrees(gps.get("lon"), gps.get("lon_ref"), "W")
+    if lat is None or lon is None:
+        return None
+    altitude = (gps.get("altitude") or [None])[0]
+    if altitude is not None and (gps.get("altitude_ref") or [0])[0] == 1:
+        altitude = -altitude
+    return lat, lon, altitude
+
+def read_gps_bulk(paths, cache_file=GPS_CACHE_FILE, workers=GPS_WORKERS):
+    """
+    Return {path: (latitude, longitude, altitude) or None} for the given photos.
+
+    The positions are cached in a JSON file by absolute path, and reused while the size and
+    mtime of the photo do not change; the other photos are read by a pool of threads.
+    """
+    with cache_lock:
+        cache = {}
+        if os.path.exists(cache_file):
+            with open(cache_file, 'r') as f:
+                cache = json.load(f)
+
+        stats, pending = {}, []
+        for path in paths:
+            key = os.path.abspath(path)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            stats[path] = (key, stat.st_size, stat.st_mtime_ns)
+            entry = cache.get(key)
+            if not entry or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+                pending.append(path)
+
+        if pending:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for path, gps in zip(pending, executor.map(read_gps, pending)):
+                    key, size, mtime_ns = stats[path]
+                    cache[key] = {"size": size, "mtime_ns": mtime_ns, "gps": gps}
+            with atomic_write(cache_file) as f:
+                json.dump(cache, f)
+
+    return {path: tuple(cache[key]["gps"]) if cache[key]["gps"] else None for path, (key, _, _) in stats.items()}
+
+def read_gps_exif(path):
+    """
+    The former reader of 30-photosToGeoJson.py with the exif library, for the benchmark.
+    """
+    from exif import Image as ExifImage
+
+    with open(path, 'rb') as image_file:
+        image = ExifImage(image_file)
+        if not image.has_exif:
+            return None
+        try:
+            lat = image.gps_latitude
+            lon = image.gps_longitude
+        except AttributeError:
+            return None
+        return lat[0] + lat[1] / 60 + lat[2] / 3600, lon[0] + lon[1] / 60 + lon[2] / 3600
+
+def benchmark(paths):
+    for name, reader in (("exif library", read_gps_exif), ("exifGps", read_gps)):
+        start = time.perf_counter()
+        results = [reader(path) for path in paths]
+        seconds = time.perf_counter() - start
+        found = sum(result is not None for result in results)
+        print(f"{name}: {seconds / max(len(paths), 1) * 1000:.2f} ms/photo, {found}/{len(paths)} with a position")
+    # The exif library ignores the references, compare the absolute values
+    differences = [
+        max(abs(abs(a[0]) - abs(b[0])), abs(abs(a[1]) - abs(b[1])))
+        for a, b in zip(map(read_gps_exif, paths), map(read_gps, paths))
+        if a and b
+    ]
+    if differences:
+        print(f"Largest difference: {max(differences):.2e} degrees")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Read the GPS positions of a folder of photos into the shared cache.")
+    parser.add_argument("folder", nargs="?", default="./photos/HikingSigns", help="Folder of JPEG photos")
+    parser.add_argument("--benchmark", action="store_true", help="Compare the speed and results with the exif library, without the cache")
+    args = parser.parse_args()
+    paths = sorted(glob.glob(os.path.join(args.folder, "*.jpg")))
+    if args.benchmark:
+        benchmark(paths)
+    else:
+        positions = read_gps_bulk(paths)
+        print(f"{sum(gps is not None for gps in positions.values())}/{len(paths)} photos with a position, cached in {GPS_CACHE_FILE}")
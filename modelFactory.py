@@ -0,0 +1,439 @@
+import os
+import sys
+import json
+import glob
+import argparse
+import functools
+from typing import Dict, List, Tuple
+import torch
+from detectron2.config import get_cfg
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.data import DatasetCatalog, MetadataCatalog
+from detectron2.data import transforms as T
+from detectron2.data.detection_utils import read_image
+from detectron2.data.datasets import register_coco_instances
+from detectron2.engine import DefaultPredictor
+from detectron2.export import STABLE_ONNX_OPSET_VERSION, scripting_with_instances
+from detectron2.modeling import build_model
+from detectron2.modeling.postprocessing import detector_postprocess
+from detectron2.structures import Boxes, Instances, pairwise_iou
+from deviceReport import configure_device
+from exifGps import atomic_write
+
+detectron2_configs = "./detectron2/configs"
+
+# Inference backends of get_predictor
+BACKENDS = ["torch", "torchscript", "onnx", "openvino", "onnx-int8"]
+
+# ONNX Runtime execution providers of the ONNX backends, in order of preference
+ONNX_PROVIDERS = {
+    "onnx": ["CPUExecutionProvider"],
+    "openvino": ["OpenVINOExecutionProvider", "CPUExecutionProvider"],
+    "onnx-int8": ["CPUExecutionProvider"],  # Model quantized by 23-quantizeObjectDetectionModel.py
+}
+
+# SHA-1 of the model files by path, size and mtime, so that the weights are not hashed at every start
+MODEL_HASH_FILE = "model_hashes.json"
+
+# Largest differences accepted between an exported backend and the torch one, see check_parity
+PARITY_BOX_TOLERANCE = 2.0  # Pixels, on each box coordinate
+PARITY_SCORE_TOLERANCE = 0.02
+PARITY_MASK_IOU = 0.9
+
+# Settings of the two models: "od" trained by script 20 and "is" trained by script 90
+MODELS = {
+    "od": {
+        "config": "COCO-Detection/faster_rcnn_R_50_FPN_3x.yaml",
+        "base_weights": "detectron2://COCO-Detection/faster_rcnn_R_50_FPN_3x/137849458/model_final_280758.pkl",
+        "output_dir": "./model-od",
+        "classes": ["top", "destination", "poster", "bike_sign", "street_sign", "panel", "compass"],
+        "train": ("coco_train", "./coco-train"),
+        "test": ("coco_test", "./coco-test"),
+        "set_metadata": True,
+        "steps": (4200, 5000),
+        "max_iter": 5400,
+    },
+    "is": {
+        "config": "COCO-InstanceSegmentation/mask_rcnn_R_50_FPN_3x.yaml",
+        "base_weights": "detectron2://COCO-InstanceSegmentation/mask_rcnn_R_50_FPN_3x/137849600/model_final_f10217.pkl",
+        "output_dir": "./model-is",
+        "classes": ["top", "destination", "poster", "bike_sign", "street_sign", "panel"],
+        "train": ("hiking_signs_train", "./coco-train-hiking-sign"),
+        "test": ("hiking_signs_test", "./coco-test-hiking-sign"),
+        "set_metadata": False,
+        "steps": (420, 500),
+        "max_iter": 540,
+    },
+}
+
+# Register the datasets of a model, once per process
+def register_datasets(kind):
+    model = MODELS[kind]
+    for name, folder in (model["train"], model["test"]):
+        if name in DatasetCatalog.list():
+            continue
+        register_coco_instances(name, {}, os.path.join(folder, "result.json"), folder)
+        # Set metadata
+        if model["set_metadata"]:
+            MetadataCatalog.get(name).set(
+                thing_classes=model["classes"],
+                evaluator_type='coco',
+            )
+
+def build_cfg(kind, training=False, weights=None):
+    """
+    Build the detectron2 config of a model.
+
+    For training, the weights are the COCO pre-trained ones; otherwise the model_final.pth
+    written to the output directory by the training script.
+    """
+    model = MODELS[kind]
+    cfg = get_cfg()
+    cfg.OUTPUT_DIR = model["output_dir"]
+
+    cfg.merge_from_file(os.path.join(detectron2_configs, model["config"]))
+    if weights is None:
+        weights = model["base_weights"] if training else os.path.join(cfg.OUTPUT_DIR, "model_final.pth")
+    cfg.MODEL.WEIGHTS = weights
+
+    cfg.MODEL.ROI_HEADS.BATCH_SIZE_PER_IMAGE = 128
+    cfg.MODEL.ROI_HEADS.NUM_CLASSES = len(model["classes"])
+    configure_device(cfg)  # Device and CPU threads from the 10-testGpu.py report
+    cfg.MODEL.MASK_ON = True
+
+    cfg.DATASETS.TRAIN = (model["train"][0],)
+    cfg.DATASETS.TEST = (model["test"][0],)
+
+    cfg.SOLVER.IMS_PER_BATCH = 2
+    cfg.SOLVER.BASE_LR = 0.02
+    cfg.SOLVER.STEPS = model["steps"]
+    cfg.SOLVER.MAX_ITER = model["max_iter"]
+
+    cfg.DATALOADER.NUM_WORKERS = 4
+    return cfg
+
+def torchscript_path(kind):
+    return os.path.join(MODELS[kind]["output_dir"], "model_final.ts")
+
+def onnx_path(kind, int8=False):
+    return os.path.join(MODELS[kind]["output_dir"], "model_final.int8.onnx" if int8 else "model_final.onnx")
+
+def postprocess(fields, input_size, height, width):
+    """
+    Turn raw model outputs into Instances at the original image size, like DefaultPredictor does.
+
+    fields holds pred_boxes (as a tensor), scores, pred_classes and pred_masks predicted on an
+    input of input_size (height, width), i.e. the image after ResizeShortestEdge.
+    """
+    instances = Instances(input_size)
+    instances.pred_boxes = Boxes(fields["pred_boxes"])
+    instances.scores = fields["scores"]
+    instances.pred_classes = fields["pred_classes"]
+    if "pred_masks" in fields:
+        instances.pred_masks = fields["pred_masks"]
+    return detector_postprocess(instances, height, width)
+
+class ScriptableAdapter(torch.nn.Module):
+    """
+    Wrap a GeneralizedRCNN so that the scripted model returns plain dicts of tensors.
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.eval()
+
+    def forward(self, inputs: Tuple[Dict[str, torch.Tensor]]) -> List[Dict[str, torch.Tensor]]:
+        instances = self.model.inference(inputs, do_postprocess=False)
+        return [i.get_fields() for i in instances]
+
+class OnnxAdapter(torch.nn.Module):
+    """
+    Wrap a GeneralizedRCNN so that the traced model maps one CHW image to plain tensors.
+
+    The outputs are the boxes, classes, scores and 28x28 mask probabilities of each instance,
+    at the size of the input, as postprocess expects them.
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.eval()
+
+    def forward(self, image):
+        instances = self.model.inference([{"image": image}], do_postprocess=False)[0]
+        return instances.pred_boxes.tensor, instances.pred_classes, instances.scores, instances.pred_masks
+
+def preprocess(predictor, original_image, output_size=None):
+    """
+    Build the model input of a BGR image, with the resize and color format of the predictor.
+
+    The predictions are returned at output_size (height, width), by default the size of the
+    image; e.g. the size of the original photo when the image was decoded at a reduced size.
+    """
+    if predictor.input_format == "RGB":
+        original_image = original_image[:, :, ::-1]
+    height, width = output_size or original_image.shape[:2]
+    image = predictor.aug.get_transform(original_image).apply_image(original_image)
+    image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
+    return {"image": image, "height": height, "width": width}
+
+def predict_batch(predictor, images, output_sizes=None):
+    """
+    Run the model once on a list of BGR images.
+
+    Returns one {"instances": Instances} dict per image, like calling the predictor on each.
+    The model pads the batch to its largest image, so similar sizes waste less work.
+    output_sizes optionally gives the (height, width) to return the predictions at, per image.
+    """
+    output_sizes = output_sizes or [None] * len(images)
+    with torch.no_grad():
+        inputs = [preprocess(predictor, image, size) for image, size in zip(images, output_sizes)]
+        if isinstance(predictor, ExportedPredictor):
+            return predictor.predict_inputs(inputs)
+        return predictor.model(inputs)
+
+class ExportedPredictor:
+    """
+    Same interface as DefaultPredictor, for the models exported by this module.
+
+    Subclasses load the exported file and implement predict_inputs.
+    """
+    def __init__(self, cfg):
+        self.cfg = cfg.clone()
+        self.aug = T.ResizeShortestEdge(
+            [cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MIN_SIZE_TEST], cfg.INPUT.MAX_SIZE_TEST
+        )
+        self.input_format = cfg.INPUT.FORMAT
+
+    def predict_inputs(self, inputs):
+        raise NotImplementedError
+
+    def __call__(self, original_image):
+        with torch.no_grad():
+            return self.predict_inputs([preprocess(self, original_image)])[0]
+
+class TorchScriptPredictor(ExportedPredictor):
+    """
+    Predictor of a model exported with export_torchscript.
+
+    Loading the TorchScript file skips building the model from the YAML config and the
+    state-dict matching of the .pth checkpoint.
+    """
+    def __init__(self, cfg, path):
+        super().__init__(cfg)
+        self.model = torch.jit.load(path, map_location=cfg.MODEL.DEVICE)
+
+    def predict_inputs(self, inputs):
+        images = tuple({"image": i["image"].to(self.cfg.MODEL.DEVICE)} for i in inputs)
+        outputs = self.model(images)
+        return [
+            {"instances": postprocess(fields, i["image"].shape[1:], i["height"], i["width"])}
+            for fields, i in zip(outputs, inputs)
+        ]
+
+class OnnxPredictor(ExportedPredictor):
+    """
+    Predictor of a model exported with export_onnx, run by ONNX Runtime on the CPU.
+
+    ONNX Runtime fuses operators and plans the memory of the whole graph, which eager PyTorch
+    cannot do; providers selects e.g. the OpenVINO execution provider, which must be installed.
+    The graph takes one image, so a batch is run image by image.
+    """
+    def __init__(self, cfg, path, providers):
+        import onnxruntime  # Only needed by the ONNX backends
+
+        super().__init__(cfg)
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = torch.get_num_threads()  # Set from the 10-testGpu.py report
+        available = onnxruntime.get_available_providers()
+        # The predictions are keyed by backend, running another provider would mislabel them
+        if providers[0] not in available:
+            raise RuntimeError(f"{providers[0]} is not installed, available providers: {', '.join(available)}")
+        self.session = onnxruntime.InferenceSession(path, options, providers=[p for p in providers if p in available])
+
+    def predict_inputs(self, inputs):
+        results = []
+        for i in inputs:
+            boxes, classes, scores, masks = self.session.run(None, {"image": i["image"].numpy()})
+            fields = {
+                "pred_boxes": torch.from_numpy(boxes),
+                "scores": torch.from_numpy(scores),
+                "pred_classes": torch.from_numpy(classes),
+                "pred_masks": torch.from_numpy(masks),
+            }
+            results.append({"instances": postprocess(fields, i["image"].shape[1:], i["height"], i["width"])})
+        return results
+
+def artifact_path(kind, backend="torch"):
+    """
+    Return the file the predictor of a backend loads the model from.
+    """
+    if backend == "torch":
+        return build_cfg(kind).MODEL.WEIGHTS
+    if backend == "torchscript":
+        return torchscript_path(kind)
+    if backend in ONNX_PROVIDERS:
+        return onnx_path(kind, int8=backend == "onnx-int8")
+    raise ValueError(f"Unknown backend: {backend}")
+
+def artifact_sha1(path, cache_file=MODEL_HASH_FILE):
+    """
+    Return the SHA-1 of a model file, cached in cache_file while its size and mtime do not change.
+    """
+    from detectionsStore import file_sha1  # Only needed by the scripts keeping predictions
+
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}"
+    cache = {}
+    if os.path.exists(cache_file):
+        with open(cache_file, 'r') as f:
+            cache = json.load(f)
+    if key not in cache:
+        # Forget the previous versions of the file
+        cache = {k: v for k, v in cache.items() if not k.startswith(os.path.abspath(path) + "|")}
+        cache[key] = file_sha1(path)
+        with atomic_write(cache_file) as f:
+            json.dump(cache, f, indent=2)
+    return cache[key]
+
+@functools.lru_cache(maxsize=None)
+def model_hash(kind, backend="torch"):
+    """
+    Return the key of the predictions of a model and backend, in the crop manifest and the detections store.
+
+    The SHA-1 of the loaded file, prefixed by the backend except for torch, so that the
+    predictions of an exported or quantized model are never taken for the torch ones.
+    """
+    sha1 = artifact_sha1(artifact_path(kind, backend))
+    return sha1 if backend == "torch" else f"{backend}:{sha1}"
+
+@functools.lru_cache(maxsize=None)
+def get_predictor(kind, backend="torch"):
+    """
+    Return the predictor of a model, built on first use and then cached for the process.
+
+    backend is "torch" for detectron2's DefaultPredictor, "torchscript" for the model
+    exported by export_torchscript, or "onnx" / "openvino" for the model exported by
+    export_onnx, run by ONNX Runtime with its CPU or OpenVINO execution provider. "onnx-int8"
+    runs the INT8 model published by 23-quantizeObjectDetectionModel.py.
+
+    The predictor has a model_hash attribute, see model_hash.
+    """
+    cfg = build_cfg(kind)
+    path = artifact_path(kind, backend)
+    if backend != "torch" and not os.path.exists(path):
+        if backend == "torchscript":
+            command = f"modelFactory.py --export {kind}"
+        elif backend == "onnx-int8":
+            command = "23-quantizeObjectDetectionModel.py"
+        else:
+            command = f"modelFactory.py --export {kind} --format onnx"
+        raise FileNotFoundError(f"{path} not found, run: python {command}")
+    if backend == "torch":
+        predictor = DefaultPredictor(cfg)
+    elif backend == "torchscript":
+        predictor = TorchScriptPredictor(cfg, path)
+    else:
+        predictor = OnnxPredictor(cfg, path, ONNX_PROVIDERS[backend])
+    predictor.model_hash = model_hash(kind, backend)
+    return predictor
+
+def export_torchscript(kind):
+    """
+    Script the trained model and save it next to model_final.pth.
+    """
+    cfg = build_cfg(kind)
+    cfg.MODEL.DEVICE = "cpu"  # Moved to the configured device by torch.jit.load
+    model = build_model(cfg)
+    DetectionCheckpointer(model).load(cfg.MODEL.WEIGHTS)
+    model.eval()
+
+    fields = {
+        "proposal_boxes": Boxes,
+        "objectness_logits": torch.Tensor,
+        "pred_boxes": Boxes,
+        "scores": torch.Tensor,
+        "pred_classes": torch.Tensor,
+        "pred_masks": torch.Tensor,
+    }
+    scripting_with_instances(ScriptableAdapter(model), fields).save(torchscript_path(kind))
+    return torchscript_path(kind)
+
+def export_onnx(kind, sample_image="assets/7-object-detection.jpg"):
+    """
+    Trace the trained model on a sample image and save it as ONNX next to model_final.pth.
+
+    The height and width of the input stay dynamic, like the number of instances.
+    """
+    cfg = build_cfg(kind)
+    cfg.MODEL.DEVICE = "cpu"  # ONNX Runtime runs it on the CPU
+    model = build_model(cfg)
+    DetectionCheckpointer(model).load(cfg.MODEL.WEIGHTS)
+    model.eval()
+
+    image = preprocess(ExportedPredictor(cfg), read_image(sample_image, format="BGR"))["image"]
+    with torch.no_grad():
+        torch.onnx.export(
+            OnnxAdapter(model),
+            (image,),
+            onnx_path(kind),
+            opset_version=STABLE_ONNX_OPSET_VERSION,
+            input_names=["image"],
+            output_names=["boxes", "classes", "scores", "masks"],
+            dynamic_axes={
+                "image": {1: "height", 2: "width"},
+                "boxes": {0: "instances"},
+                "classes": {0: "instances"},
+                "scores": {0: "instances"},
+                "masks": {0: "instances"},
+            },
+        )
+    return onnx_path(kind)
+
+def check_parity(kind, backend, image_paths):
+    """
+    Compare the predictions of an exported backend with the torch ones, image by image.
+
+    Each torch instance is matched with the instance of the same class and best box IoU. Returns
+    False if an instance is missing, or if a box, score or mask differs beyond the tolerances.
+    """
+    reference, candidate = get_predictor(kind), get_predictor(kind, backend)
+    ok = True
+    for image_path in image_paths:
+        image = read_image(image_path, format="BGR")
+        expected = reference(image)["instances"].to("cpu")
+        actual = candidate(image)["instances"].to("cpu")
+        iou = pairwise_iou(expected.pred_boxes, actual.pred_boxes)
+        worst_box, worst_score, worst_mask, missing = 0.0, 0.0, 1.0, 0
+        for i in range(len(expected)):
+            same_class = actual.pred_classes == expected.pred_classes[i]
+            if not same_class.any():
+                missing += 1
+                continue
+            j = int(torch.where(same_class, iou[i], torch.tensor(-1.0)).argmax())
+            worst_box = max(worst_box, float((expected.pred_boxes.tensor[i] - actual.pred_boxes.tensor[j]).abs().max()))
+            worst_score = max(worst_score, abs(float(expected.scores[i] - actual.scores[j])))
+            if expected.has("pred_masks"):
+                union = (expected.pred_masks[i] | actual.pred_masks[j]).sum()
+                mask_iou = float((expected.pred_masks[i] & actual.pred_masks[j]).sum() / union) if union else 1.0
+                worst_mask = min(worst_mask, mask_iou)
+        passed = missing == 0 and worst_box <= PARITY_BOX_TOLERANCE and worst_score <= PARITY_SCORE_TOLERANCE and worst_mask >= PARITY_MASK_IOU
+        ok = ok and passed
+        print(f"{'OK  ' if passed else 'FAIL'} {image_path}: {len(expected)} vs {len(actual)} instances, {missing} missing, "
+              f"box {worst_box:.2f} px, score {worst_score:.3f}, mask IoU {worst_mask:.3f}")
+    return ok
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the trained detectron2 models.")
+    parser.add_argument("--export", choices=sorted(MODELS), help="Model to export")
+    parser.add_argument("--format", choices=["torchscript", "onnx"], default="torchscript", help="Format of the exported model")
+    parser.add_argument("--parity", choices=sorted(MODELS), help="Compare an exported backend with torch on the images of assets/")
+    parser.add_argument("--backend", choices=BACKENDS[1:], default="onnx", help="Backend compared by --parity")
+    args = parser.parse_args()
+    if not args.export and not args.parity:
+        parser.error("one of --export or --parity is required")
+    if args.export:
+        export = export_onnx if args.format == "onnx" else export_torchscript
+        print(f"Model exported to {export(args.export)}")
+    if args.parity and not check_parity(args.parity, args.backend, sorted(glob.glob("assets/*.jpg"))):
+        sys.exit(1)